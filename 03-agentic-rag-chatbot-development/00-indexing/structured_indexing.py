@@ -0,0 +1,250 @@
+"""
+Structure-aware indexing of Canvas guides
+
+Variant of the `Indexing` class in 00-indexing.ipynb. Instead of fixed 4200 character chunks, each guide page
+is split on its heading/ step structure into small retrieval units (one step/ section each, long sections are
+split further). Units are embedded into their own collection, the full pages are kept in a parent document
+store so retrieval can expand a matched unit to its page on demand.
+
+re-index (sources are taken from the existing 'guides' collection unless a file of urls is given):
+    python structured_indexing.py --reindex
+    python structured_indexing.py --reindex --sources urls.txt
+
+fixed size chunks (same as the `Indexing` class, chunk size other than 4200) into 'guides_cs<chunk_size>',
+e.g. for the chunk size axis of ../02-retrieval-evaluation/retrieval_sweep.py:
+    python structured_indexing.py --chunk-size 1000
+
+a tenant's knowledge base (collection and parent store from TENANTS_FILE/ --tenants-file, see
+../05-final-product/tenants.py):
+    python structured_indexing.py --reindex --tenant acme --sources acme_urls.txt
+
+chunks are embedded through the embedding cache shared with the chatbot, so guides common to several
+tenants' collections are only embedded once.
+"""
+
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_classic.document_loaders import WebBaseLoader
+from langchain_text_splitters.character import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_ollama import OllamaEmbeddings
+from langchain_chroma import Chroma
+import argparse
+import sys
+import os
+import re
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "05-final-product"))
+from parent_store import ParentDocumentStore
+from tenants import load_tenants, parent_docstore_path, shared_embeddings
+
+
+PERSIST_DIRECTORY = "../data/chroma_knowledge_base"
+PARENT_DOCSTORE = "../data/parent_docstore"
+EMBEDDING_CACHE_DIR = "../data/embedding_cache"
+
+HEADING_TAGS = ["h1", "h2", "h3", "h4"]
+BLOCK_TAGS = ["p", "li", "pre", "table"]
+
+
+###########################################
+# Structured Indexing
+###########################################
+class StructuredIndexing:
+
+    def __init__(self, sources: list[str], embedding_model, collection_name="guides_units", max_unit_size=800, unit_overlap=100, parent_docstore=PARENT_DOCSTORE):
+        self._sources = sources
+        self._collection_name = collection_name
+        self._text_splitter = RecursiveCharacterTextSplitter(chunk_size=max_unit_size, chunk_overlap=unit_overlap, length_function=len)
+        self._embedding_model = embedding_model
+        self._parent_store = ParentDocumentStore(parent_docstore)
+        self._total_units = 0
+
+    def _clean_text(self, text):
+        """Clean video transcript and reference labels (same rules as Indexing._clean_page_content)"""
+
+        matches = re.findall('[0-9]{2}:[0-9]{2}: [0-9A-Za-z \'";.,!?-]*', text)
+
+        if len(matches) >= 2:
+            idx1 = text.find(matches[0])
+            idx2 = text.find(matches[-2]) + len(matches[-2])
+            text = text[:idx1] + text[idx2:]
+        text = re.sub(r'\[\d+\]', '', text)
+        text = re.sub('[0-9]{2}:[0-9]{2}: ', '', text)
+
+        return text.strip()
+
+    def _page_metadata(self, source):
+
+        """doc_id and doc_title and guide_type of a page (same as Indexing._populate_metadata)"""
+
+        return {
+            'source': source,
+            'doc_id': self._sources.index(source),
+            'doc_title': " ".join(source.split("/")[-3].split("-")),
+            'guide_type': " ".join(source.split("/")[-4].split("-")),
+        }
+
+    def _prepend_additional_info(self, text, metadata):
+
+        """Prepend unit text with parent doc_tile and guide_type"""
+
+        return f"Guide Type: {metadata['guide_type']}\n\nDocument Title: {metadata['doc_title']}\n\n" + text
+
+    def _split_sections(self, content):
+
+        """Split page content on its headings, each section is the heading + the blocks up to the next heading"""
+
+        sections, heading, blocks = [], None, []
+
+        for element in content.find_all(HEADING_TAGS + BLOCK_TAGS):
+            if element.name in BLOCK_TAGS and element.find_parent(["li", "table"]):
+                continue # nested block, already part of its parent's text
+
+            text = element.get_text(separator=" ", strip=True)
+            if not text:
+                continue
+
+            if element.name in HEADING_TAGS:
+                if blocks:
+                    sections.append((heading, blocks))
+                heading, blocks = text, []
+            else:
+                blocks.append(text)
+
+        if blocks:
+            sections.append((heading, blocks))
+
+        return sections
+
+    def _units(self, source, content):
+
+        metadata = self._page_metadata(source)
+        parent_id = f"page-{metadata['doc_id']}"
+
+        units = []
+        for section_idx, (heading, blocks) in enumerate(self._split_sections(content)):
+            text = self._clean_text("\n".join(([heading] if heading else []) + blocks))
+            for piece in self._text_splitter.split_text(text) if text else []:
+                units.append(Document(
+                    id=f"{parent_id}-{len(units)}",
+                    page_content=self._prepend_additional_info(piece, metadata),
+                    metadata={**metadata, 'parent_id': parent_id, 'section': heading or "", 'section_idx': section_idx, 'unit_idx': len(units)},
+                ))
+
+        parent = Document(
+            page_content=self._prepend_additional_info(self._clean_text(content.get_text(separator=" ", strip=True)), metadata),
+            metadata={**metadata, 'parent_id': parent_id},
+        )
+
+        return parent_id, parent, units
+
+    def generate_vectorstore(self, reindex=False):
+
+        vectorstore = Chroma(
+            embedding_function=self._embedding_model,
+            collection_name=self._collection_name,
+            persist_directory=PERSIST_DIRECTORY,
+        )
+
+        if reindex:
+            vectorstore.reset_collection()
+            if self._parent_store is not None:
+                self._parent_store.clear()
+
+        loader = WebBaseLoader(web_paths=self._sources)
+
+        for source, soup in zip(self._sources, loader.scrape_all(self._sources)):
+            content = soup.find(id="content") or soup # filtering web data
+            parent_id, parent, units = self._units(source, content)
+            if not units:
+                continue
+
+            if self._parent_store is not None:
+                self._parent_store.put(parent_id, parent)
+            vectorstore.add_documents(units, ids=[unit.id for unit in units])
+            self._total_units += len(units)
+
+        return vectorstore
+
+
+class FixedSizeIndexing(StructuredIndexing):
+    """fixed size chunks of the whole page (as the `Indexing` class of 00-indexing.ipynb), no parent pages"""
+
+    def __init__(self, sources: list[str], embedding_model, chunk_size, chunk_overlap=200, collection_name=None):
+        super().__init__(sources, embedding_model, collection_name=collection_name or f"guides_cs{chunk_size}", max_unit_size=chunk_size, unit_overlap=chunk_overlap)
+        self._parent_store = None # nothing of this collection lives in the parent store
+
+    def _units(self, source, content):
+
+        metadata = self._page_metadata(source)
+        text = self._clean_text(content.get_text(separator=" ", strip=True))
+
+        chunks = [
+            Document(id=f"page-{metadata['doc_id']}-{idx}", page_content=self._prepend_additional_info(piece, metadata), metadata=dict(metadata))
+            for idx, piece in enumerate(self._text_splitter.split_text(text) if text else [])
+        ]
+
+        return None, None, chunks
+
+
+###########################################
+# Re-index
+###########################################
+def indexed_sources(embedding_model, collection_name="guides"):
+    """source urls of an existing collection, ordered by doc_id"""
+
+    vectorstore = Chroma(embedding_function=embedding_model, collection_name=collection_name, persist_directory=PERSIST_DIRECTORY)
+    doc_ids = {metadata['source']: metadata['doc_id'] for metadata in vectorstore.get(include=["metadatas"])["metadatas"]}
+
+    return sorted(doc_ids, key=doc_ids.get)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Structure-aware (re-)indexing of Canvas guides")
+    parser.add_argument("--sources", default=None, help="file with one url per line, default: sources of the 'guides' collection")
+    parser.add_argument("--collection", default=None, help="default: the tenant's collection with --tenant, 'guides_units' otherwise")
+    parser.add_argument("--parent-docstore", default=None, help=f"default: the tenant's parent store with --tenant, '{PARENT_DOCSTORE}' otherwise")
+    parser.add_argument("--tenant", default=None, help="index the knowledge base of this tenant")
+    parser.add_argument("--tenants-file", default=os.getenv("TENANTS_FILE"), help="tenant configs (json), default: $TENANTS_FILE")
+    parser.add_argument("--max-unit-size", type=int, default=800)
+    parser.add_argument("--chunk-size", type=int, default=None, help="index fixed size chunks into 'guides_cs<chunk_size>' instead of structure-aware units")
+    parser.add_argument("--reindex", action="store_true", help="drop the collection and parent store before indexing")
+    args = parser.parse_args()
+
+    collection, parent_docstore = args.collection, args.parent_docstore
+    if args.tenant:
+        try:
+            tenants = load_tenants(args.tenants_file, default_tenant_id=args.tenant)
+        except ValueError as e:
+            parser.error(str(e))
+        collection = collection or tenants[args.tenant]["collection_name"]
+        parent_docstore = parent_docstore or parent_docstore_path(args.tenant, tenants[args.tenant])
+
+    # identical chunks are embedded once across all tenants' collections (same cache as the chatbot)
+    emb_model = shared_embeddings(OllamaEmbeddings(model="bge-m3:latest", num_thread=4), EMBEDDING_CACHE_DIR, namespace="bge-m3:latest")
+
+    if args.sources:
+        with open(args.sources) as f:
+            sources = [line.strip() for line in f if line.strip()]
+    else:
+        sources = indexed_sources(emb_model)
+
+    if args.chunk_size:
+        indexing = FixedSizeIndexing(sources, emb_model, chunk_size=args.chunk_size, collection_name=collection)
+    else:
+        indexing = StructuredIndexing(
+            sources,
+            emb_model,
+            collection_name=collection or "guides_units",
+            max_unit_size=args.max_unit_size,
+            parent_docstore=parent_docstore or PARENT_DOCSTORE,
+        )
+    indexing.generate_vectorstore(reindex=args.reindex)
+    print(f"indexed {indexing._total_units} units from {len(sources)} pages into '{indexing._collection_name}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+Retrieval quality vs. latency sweep with cached runs
+
+Sweeps retrieval configurations (k, dense/ hybrid search, reranker, compression mode, knowledge base
+collection: chunk size or any indexed collection),
+judges every retrieval context with deepeval's Contextual Relevancy metric and prints a Pareto table of
+relevancy against p95 latency and context tokens.
+
+Retrieval outputs and judge verdicts are cached by content hash under ../data/eval_cache, so a re-run
+only computes configurations/ questions that changed.
+
+usage:
+    python retrieval_sweep.py --k 5 10 20 --search dense hybrid --reranker off on --compression none merge
+    python retrieval_sweep.py --chunk-size 1000 4200 --collection guides_units
+
+chunk sizes other than 4200 are read from 'guides_cs<chunk_size>' collections, build them with
+    python ../00-indexing/structured_indexing.py --chunk-size 1000
+"""
+
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from dotenv import load_dotenv, find_dotenv
+from langchain_ollama import OllamaEmbeddings
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from datetime import datetime
+import pandas as pd
+import itertools
+import argparse
+import hashlib
+import json
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "05-final-product"))
+from result_merging import merge_documents, approx_tokens
+
+
+###########################################
+# LOADING ENV Variables
+###########################################
+load_dotenv(find_dotenv())
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+CACHE_DIR = os.path.join(DATA_DIR, "eval_cache")
+RESULTS_DIR = os.path.join(DATA_DIR, "eval_results")
+DATASET = os.path.join(DATA_DIR, "datasets", "canvas_community_forum.csv")
+
+DEFAULT_CHUNK_SIZE = 4200 # chunk size of the 'guides' collection (see 00-indexing)
+DEFAULT_COLLECTION = "guides"
+
+# bump to invalidate cached retrievals when the way they are produced/ timed changes
+RETRIEVAL_CACHE_VERSION = 2
+
+
+###########################################
+# Helper: Content Hash Cache
+###########################################
+def content_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class JsonCache:
+    """one json file per content hash"""
+
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self._directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key)) # never leave half written entries behind
+        return value
+
+
+###########################################
+# Knowledge Base Setup
+###########################################
+emb_model = OllamaEmbeddings(model="bge-m3:latest", num_thread=4)
+
+_vectorstores = {}
+_bm25_retrievers = {}
+_reranker = None
+
+
+def collection_name(chunk_size):
+    return DEFAULT_COLLECTION if chunk_size == DEFAULT_CHUNK_SIZE else f"guides_cs{chunk_size}"
+
+
+def get_vectorstore(collection):
+    if collection not in _vectorstores:
+        _vectorstores[collection] = Chroma(
+            embedding_function=emb_model,
+            collection_name=collection,
+            persist_directory=os.path.join(DATA_DIR, "chroma_knowledge_base"),
+        )
+    return _vectorstores[collection]
+
+
+def collection_fingerprint(collection):
+    """changes whenever the collection is re-indexed, invalidating cached retrievals"""
+    ids = get_vectorstore(collection).get(include=[])
+    return content_hash(sorted(ids["ids"]))
+
+
+def get_bm25_retriever(collection, k):
+    from langchain_community.retrievers import BM25Retriever
+
+    if collection not in _bm25_retrievers:
+        stored = get_vectorstore(collection).get(include=["documents", "metadatas"])
+        docs = [Document(page_content=text, metadata=metadata or {}, id=doc_id) for doc_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])]
+        _bm25_retrievers[collection] = BM25Retriever.from_documents(docs)
+
+    retriever = _bm25_retrievers[collection]
+    retriever.k = k
+    return retriever
+
+
+def get_reranker():
+    global _reranker
+    from sentence_transformers import CrossEncoder
+
+    if _reranker is None:
+        _reranker = CrossEncoder("BAAI/bge-reranker-v2-m3")
+    return _reranker
+
+
+def compression_model_id():
+    """model used by 'llm' compression, resolved like the backend's model router (fast tier, strong as fallback)"""
+    model_id = os.getenv("MODEL_ID2") or os.getenv("MODEL_ID1")
+    adaptive = os.getenv("ADAPTIVE_MODEL_ROUTING", "false").lower() in ("1", "true", "yes")
+    return f"{model_id}+adaptive:{os.getenv('MODEL_ID1')}" if adaptive else model_id
+
+
+def warm_up(config):
+    """
+    one-off start-up work of a configuration (embedding model load, BM25 index, reranker load, backend import)
+    so it isn't timed as the latency of the first question
+    """
+
+    candidates = config["k"] * 3 if config["reranker"] == "on" else config["k"]
+    get_vectorstore(config["collection"]).similarity_search("warm up", k=1)
+    if config["search"] == "hybrid":
+        get_bm25_retriever(config["collection"], candidates).invoke("warm up")
+    if config["reranker"] == "on":
+        get_reranker().predict([("warm up", "warm up")])
+    if config["compression"] == "llm":
+        import langgraph_backend # noqa: F401
+
+
+###########################################
+# Retrieval Configurations
+###########################################
+def reciprocal_rank_fusion(result_lists, k, rrf_k=60):
+    scores, docs = {}, {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc.id or content_hash(doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+def retrieve(question, config):
+    """retrieval context (list of strings) for one question under one configuration"""
+
+    k = config["k"]
+    candidates = k * 3 if config["reranker"] == "on" else k
+    vectorstore = get_vectorstore(config["collection"])
+
+    docs = vectorstore.similarity_search(question, k=candidates)
+    if config["search"] == "hybrid":
+        docs = reciprocal_rank_fusion([docs, get_bm25_retriever(config["collection"], candidates).invoke(question)], candidates)
+
+    if config["reranker"] == "on":
+        scores = get_reranker().predict([(question, doc.page_content) for doc in docs])
+        docs = [doc for _, doc in sorted(zip(scores, docs), key=lambda pair: pair[0], reverse=True)]
+    docs = docs[:k]
+
+    if config["compression"] == "merge":
+        docs, _, _ = merge_documents(docs)
+
+    context = [doc.page_content for doc in docs]
+
+    if config["compression"] == "llm":
+        from langgraph_backend import compress_documents # needs bedrock credentials, imported on demand
+        context = [doc for doc in compress_documents(question, context) if doc.strip()]
+
+    return context
+
+
+###########################################
+# Judge
+###########################################
+class Judge:
+    """contextual relevancy verdicts, cached by (input, retrieval context, judge settings)"""
+
+    def __init__(self, model_name, threshold, cache):
+        self._model_name = model_name
+        self._threshold = threshold
+        self._cache = cache
+        self._metric = None
+
+    def _get_metric(self):
+        from deepeval.models import GPTModel
+        from deepeval.metrics import ContextualRelevancyMetric
+
+        if self._metric is None:
+            self._metric = ContextualRelevancyMetric(
+                threshold=self._threshold,
+                model=GPTModel(model=self._model_name, temperature=1),
+                include_reason=True,
+            )
+        return self._metric
+
+    def verdict(self, question, expected_output, retrieval_context):
+        key = content_hash({"judge": self._model_name, "threshold": self._threshold, "input": question, "retrieval_context": retrieval_context})
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        from deepeval.test_case import LLMTestCase
+
+        metric = self._get_metric()
+        metric.measure(LLMTestCase(input=question, actual_output="", expected_output=expected_output, retrieval_context=retrieval_context))
+        return self._cache.put(key, {"score": metric.score, "success": metric.is_successful(), "reason": metric.reason})
+
+
+###########################################
+# Sweep
+###########################################
+def config_name(config):
+    return f"k={config['k']}|{config['search']}|rerank={config['reranker']}|{config['compression']}|kb={config['collection']}"
+
+
+def percentile(values, pct):
+    return float(pd.Series(values).quantile(pct / 100)) if values else 0.0
+
+
+def run_config(config, dataset, judge, retrieval_cache):
+    fingerprint = collection_fingerprint(config["collection"])
+    key_config = {**config, "compression_model": compression_model_id()} if config["compression"] == "llm" else config
+    scores, successes, latencies, tokens = [], [], [], []
+    computed = 0
+
+    for question, expected_output in dataset:
+        key = content_hash({"version": RETRIEVAL_CACHE_VERSION, "config": key_config, "collection": fingerprint, "question": question})
+        cached = retrieval_cache.get(key)
+        if cached is None:
+            if not computed:
+                warm_up(config)
+            started = time.perf_counter()
+            context = retrieve(question, config)
+            cached = retrieval_cache.put(key, {"retrieval_context": context, "latency_s": time.perf_counter() - started})
+            computed += 1
+
+        verdict = judge.verdict(question, expected_output, cached["retrieval_context"])
+        scores.append(verdict["score"])
+        successes.append(verdict["success"])
+        latencies.append(cached["latency_s"])
+        tokens.append(sum(approx_tokens(text) for text in cached["retrieval_context"]))
+
+    return {
+        "config": config_name(config),
+        **config,
+        "relevancy_mean": sum(scores) / len(scores),
+        "pass_rate": sum(successes) / len(successes),
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "tokens_mean": sum(tokens) / len(tokens),
+        "recomputed": computed,
+    }
+
+
+def mark_pareto(results):
+    """a config is pareto optimal if no other config is at least as good on relevancy, p95 latency and tokens and better on one"""
+
+    def dominates(a, b):
+        at_least = a["relevancy_mean"] >= b["relevancy_mean"] and a["latency_p95_s"] <= b["latency_p95_s"] and a["tokens_mean"] <= b["tokens_mean"]
+        better = a["relevancy_mean"] > b["relevancy_mean"] or a["latency_p95_s"] < b["latency_p95_s"] or a["tokens_mean"] < b["tokens_mean"]
+        return at_least and better
+
+    for result in results:
+        result["pareto"] = not any(dominates(other, result) for other in results if other is not result)
+    return results
+
+
+def recommend(table, baseline):
+    """fastest configuration whose relevancy doesn't regress below the baseline"""
+    if baseline not in set(table["config"]):
+        return None
+    baseline_relevancy = table.loc[table["config"] == baseline, "relevancy_mean"].iloc[0]
+    candidates = table[table["relevancy_mean"] >= baseline_relevancy].sort_values(["latency_p95_s", "tokens_mean"])
+    return candidates.iloc[0]["config"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep retrieval configurations and report relevancy vs. latency/ tokens")
+    parser.add_argument("--k", type=int, nargs="+", default=[20])
+    parser.add_argument("--search", nargs="+", choices=["dense", "hybrid"], default=["dense"])
+    parser.add_argument("--reranker", nargs="+", choices=["off", "on"], default=["off"])
+    parser.add_argument("--compression", nargs="+", choices=["none", "merge", "llm"], default=["none"])
+    parser.add_argument("--chunk-size", type=int, nargs="*", default=None, help=f"read from 'guides_cs<chunk_size>' collections ({DEFAULT_CHUNK_SIZE}: '{DEFAULT_COLLECTION}')")
+    parser.add_argument("--collection", nargs="*", default=None, help="any other indexed collections, e.g. guides_units")
+    parser.add_argument("--dataset", default=DATASET)
+    parser.add_argument("--limit", type=int, default=None, help="only evaluate the first N questions")
+    parser.add_argument("--judge-model", default="o4-mini")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--baseline", default=None, help=f"config name to compare against, default: k=20|dense|rerank=off|none|kb={DEFAULT_COLLECTION}")
+    args = parser.parse_args()
+
+    dataset = pd.read_csv(args.dataset)[["input", "expected_output"]].values.tolist()[:args.limit]
+
+    retrieval_cache = JsonCache(os.path.join(CACHE_DIR, "retrieval"))
+    judge = Judge(args.judge_model, args.threshold, JsonCache(os.path.join(CACHE_DIR, "judge")))
+
+    collections = [collection_name(chunk_size) for chunk_size in args.chunk_size or []] + (args.collection or [])
+    collections = list(dict.fromkeys(collections or [DEFAULT_COLLECTION]))
+
+    results = []
+    for k, search, reranker, compression, collection in itertools.product(args.k, args.search, args.reranker, args.compression, collections):
+        config = {"k": k, "search": search, "reranker": reranker, "compression": compression, "collection": collection}
+        if not get_vectorstore(collection).get(limit=1, include=[])["ids"]:
+            hint = f" (python ../00-indexing/structured_indexing.py --chunk-size {collection.removeprefix('guides_cs')})" if collection.startswith("guides_cs") else ""
+            print(f"skipping {config_name(config)}: collection '{collection}' is empty{hint}")
+            continue
+
+        print(f"evaluating {config_name(config)} ...")
+        results.append(run_config(config, dataset, judge, retrieval_cache))
+
+    if not results:
+        return
+
+    table = pd.DataFrame(mark_pareto(results)).sort_values(["pareto", "relevancy_mean", "latency_p95_s"], ascending=[False, False, True])
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output_path = os.path.join(RESULTS_DIR, f"retrieval_sweep_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    table.to_csv(output_path, index=False)
+
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(table[["config", "relevancy_mean", "pass_rate", "latency_p95_s", "tokens_mean", "pareto", "recomputed"]].to_string(index=False))
+    print(f"\nsaved to {output_path}")
+
+    baseline = args.baseline or f"k=20|dense|rerank=off|none|kb={DEFAULT_COLLECTION}"
+    recommended = recommend(table, baseline)
+    if recommended:
+        print(f"fastest configuration without relevancy regression vs. {baseline}: {recommended}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,518 @@
+"""
+Offline batch answering of question sets
+
+Answers every question of a csv/ jsonl file (e.g. ../data/datasets/*.csv, column 'input') with bounded
+concurrency and streams one json line per question to the output file (input record + 'actual_output'),
+ready to be turned into deepeval test cases.
+
+- identical questions (same normalized text) are answered once and the answer is reused
+- near-identical questions (cosine similarity of their embeddings >= --similarity) are answered one after
+  the other in a shared retrieval cache group, so they reuse each other's retrieval results (compressions
+  are only reused for the same question, they keep what is relevant to one question)
+- questions already in the output file are skipped, an interrupted run is resumed by running it again
+
+modes:
+- graph (default): each question runs through the full agent graph (not persisted to the chat database)
+- batch-inference: retrieval + compression run locally through the retrieval pipeline, the final answers
+  are generated by a batch job, either Bedrock batch inference (--submitter bedrock, needs an s3 location
+  and a service role) or its local stand-in (--submitter local) which takes the same records. The records
+  carry no tools, their system prompt drops the tool use section and answers from the <retrieved_information>
+  sent with the question only
+
+usage:
+    python batch_answering.py ../data/datasets/synthetic_dataset-student-guide.csv --concurrency 8
+    python batch_answering.py questions.jsonl --output answers.jsonl --similarity 0.85
+    python batch_answering.py questions.csv --mode batch-inference --submitter bedrock --s3-uri s3://bucket/prefix --role-arn arn:aws:iam::...
+"""
+
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_core.messages import HumanMessage
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from retrieval_cache import normalize_query, cosine_similarity
+from langgraph_backend import (
+    batch_chatbot,
+    retrieval_pipeline,
+    retrieval_cache,
+    retrieval_stats,
+    build_system_prompt,
+    tenant_registry,
+    refresh_aws_credentials,
+    router,
+    export_model_usage,
+    emb_model,
+    BEDROCK_REGION,
+    DEFAULT_TENANT_ID,
+    PREFETCH_SIMILARITY,
+)
+import pandas as pd
+import threading
+import argparse
+import boto3
+import json
+import time
+import uuid
+import sys
+import os
+
+
+RESULTS_DIR = "../data/batch_results"
+
+
+###########################################
+# Loading Questions
+###########################################
+def load_questions(path, question_field="input", id_field=None):
+    """records of a csv/ jsonl file with the question under 'input' and an 'id' (id_field, row number by default)"""
+
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        rows = pd.read_csv(path).fillna("").to_dict(orient="records")
+
+    records = []
+    for idx, row in enumerate(rows):
+        question = str(row.get(question_field) or "").strip()
+        if question:
+            records.append({**row, "id": str(row[id_field]) if id_field else str(idx), "input": question})
+
+    return records
+
+
+###########################################
+# Grouping
+###########################################
+def group_questions(records, similarity_threshold=PREFETCH_SIMILARITY):
+    """
+    clusters of near-identical questions (cosine similarity of the question embeddings >= similarity_threshold
+    to the cluster's first question, the measure the retrieval cache matches on; token overlap is none, a single
+    word can change what is asked). each cluster is {normalized question: [records]}, records sharing a
+    normalized question are answered once.
+    """
+
+    distinct = list(dict.fromkeys(normalize_query(record["input"]) for record in records))
+    embeddings = dict(zip(distinct, emb_model.embed_documents(distinct))) if distinct else {}
+
+    clusters, representatives = [], []
+    for record in records:
+        normalized = normalize_query(record["input"])
+
+        best_idx, best_score = None, 0.0
+        for idx, representative in enumerate(representatives):
+            score = 1.0 if representative == normalized else cosine_similarity(embeddings[representative], embeddings[normalized])
+            if score >= similarity_threshold and score > best_score:
+                best_idx, best_score = idx, score
+
+        if best_idx is None:
+            representatives.append(normalized)
+            clusters.append({})
+            best_idx = len(clusters) - 1
+        clusters[best_idx].setdefault(normalized, []).append(record)
+
+    return clusters
+
+
+###########################################
+# Results
+###########################################
+class ResultWriter:
+    """appends result rows to a jsonl file as they are produced, ids already in it are finished questions"""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def completed_ids(self):
+        if not os.path.exists(self._path):
+            return set()
+
+        completed = set()
+        with open(self._path) as f:
+            for line in f:
+                try:
+                    completed.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    continue # partial last line of an interrupted run
+        return completed
+
+    def write(self, rows):
+        with self._lock, open(self._path, "a") as f:
+            for row in rows:
+                f.write(json.dumps(row, default=str) + "\n")
+            f.flush()
+
+
+def result_rows(records, answer, group_id, latency, retrieval_context=None):
+    """one row per record of an identical-question set, all sharing the answer of the first one"""
+
+    rows = []
+    for record in records:
+        row = {**record, "actual_output": answer, "group": group_id, "answered_as": records[0]["id"], "latency_s": round(latency, 3)}
+        if retrieval_context is not None:
+            row["retrieval_context"] = retrieval_context
+        rows.append(row)
+    return rows
+
+
+def batch_config(thread_id, tenant_id):
+    return {'configurable': {'thread_id': thread_id, 'tenant_id': tenant_id, 'batch': True}, 'run_name': 'batch_question'}
+
+
+def run_cluster(run_id, cluster_idx, cluster, step):
+    """
+    runs step(question, thread_id) for each distinct question of a cluster, in order, with all the cluster's
+    threads in one retrieval cache group. returns [(records, result or exception, latency)]
+    """
+
+    group_id = f"{run_id}-{cluster_idx}"
+    thread_ids = {normalized: f"batch-{group_id}-{n}" for n, normalized in enumerate(cluster)}
+    for thread_id in thread_ids.values():
+        retrieval_cache.join_group(thread_id, group_id)
+
+    outcomes = []
+    try:
+        for normalized, records in cluster.items():
+            started = time.perf_counter()
+            try:
+                result = step(records[0]["input"], thread_ids[normalized])
+            except Exception as e: # a failed question is retried on the next run
+                result = e
+            outcomes.append((records, result, time.perf_counter() - started))
+    finally:
+        for thread_id in thread_ids.values():
+            retrieval_cache.leave_group(thread_id)
+
+    return group_id, outcomes
+
+
+def run_clusters(clusters, step, concurrency, on_outcome):
+    run_id = uuid.uuid4().hex[:8]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_cluster, run_id, idx, cluster, step) for idx, cluster in enumerate(clusters)]
+        for future in as_completed(futures):
+            group_id, outcomes = future.result()
+            for records, result, latency in outcomes:
+                on_outcome(group_id, records, result, latency)
+
+
+def report_failure(records, error):
+    print(f"question {records[0]['id']} failed: {error!r}", file=sys.stderr)
+
+
+###########################################
+# Mode: Agent Graph
+###########################################
+def answer_with_graph(clusters, writer, tenant_id, concurrency):
+    failures = 0
+
+    def step(question, thread_id):
+        result = batch_chatbot.invoke({'messages': [HumanMessage(content=question)]}, config=batch_config(thread_id, tenant_id))
+        return result['messages'][-1].text
+
+    def on_outcome(group_id, records, result, latency):
+        nonlocal failures
+        if isinstance(result, Exception):
+            failures += 1
+            report_failure(records, result)
+        else:
+            writer.write(result_rows(records, result, group_id, latency))
+
+    run_clusters(clusters, step, concurrency, on_outcome)
+    return failures
+
+
+###########################################
+# Batch Inference Submitters
+###########################################
+# records follow the Bedrock batch inference format: {"recordId", "modelInput"} in, {"recordId", "modelOutput"}
+# (or {"recordId", "error"}) out, modelInput/ modelOutput in the Anthropic messages format
+def answer_record(record_id, system, question, retrieved_information, max_tokens=2500, temperature=0.2):
+    information = "\n\n".join(doc for doc in retrieved_information if doc.strip()) or "No relevant information was found."
+    prompt = f"Information obtained from the knowledge base:\n<retrieved_information>\n{information}\n</retrieved_information>\n\nUser message: {question}"
+
+    return {
+        "recordId": record_id,
+        "modelInput": {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "system": system,
+            "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+        },
+    }
+
+
+def output_text(output):
+    return "".join(block.get("text", "") for block in output["modelOutput"]["content"] if block.get("type") == "text")
+
+
+class LocalBatchSubmitter:
+    """
+    Local stand-in for Bedrock batch inference: same records, same outputs, generated with the chat model
+    with bounded concurrency. Outputs are appended to a file per job so waiting on a job again resumes it.
+    """
+
+    def __init__(self, job_dir, concurrency=4):
+        self._job_dir = job_dir
+        self._concurrency = concurrency
+        os.makedirs(job_dir, exist_ok=True)
+
+    def _path(self, job_id, kind):
+        return os.path.join(self._job_dir, f"{job_id}.{kind}.jsonl")
+
+    def _read(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _model(self, model_input):
+        # cached by the router, rebuilt after a credential refresh
+        return router.chat_model(role="chat", system=model_input["system"], max_tokens=model_input["max_tokens"], temperature=model_input["temperature"])
+
+    def _run(self, record):
+        model_input = record["modelInput"]
+        question = "\n".join(block["text"] for block in model_input["messages"][-1]["content"] if block["type"] == "text")
+        try:
+            started = time.perf_counter()
+            response = self._model(model_input).invoke([HumanMessage(content=question)])
+            router.record("chat", router.model_for("chat"), time.perf_counter() - started, response)
+        except Exception as e:
+            return {"recordId": record["recordId"], "error": {"errorMessage": repr(e)}}
+        return {"recordId": record["recordId"], "modelOutput": {"content": [{"type": "text", "text": response.text}]}}
+
+    def submit(self, records):
+        job_id = f"local-{uuid.uuid4().hex[:12]}"
+        with open(self._path(job_id, "in"), "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return job_id
+
+    def wait(self, job_id, poll_interval=None):
+        done = {output["recordId"] for output in self._read(self._path(job_id, "out")) if "modelOutput" in output}
+        pending = [record for record in self._read(self._path(job_id, "in")) if record["recordId"] not in done]
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor, open(self._path(job_id, "out"), "a") as f:
+            for output in executor.map(self._run, pending):
+                f.write(json.dumps(output) + "\n")
+                f.flush()
+
+    def results(self, job_id):
+        outputs = {}
+        for output in self._read(self._path(job_id, "out")):
+            if "modelOutput" in output or output["recordId"] not in outputs: # a later success replaces an earlier error
+                outputs[output["recordId"]] = output
+        return list(outputs.values())
+
+
+class BedrockBatchSubmitter:
+    """
+    Bedrock batch inference (create_model_invocation_job): records are uploaded to s3_uri, outputs are read
+    back from the job's output location. Bedrock has a minimum number of records per job (model dependent),
+    use the local submitter for small question sets.
+    """
+
+    TERMINAL_FAILURES = ("Failed", "Stopped", "Expired")
+
+    def __init__(self, model_id, s3_uri, role_arn, region_name):
+        self._model_id = model_id
+        self._bucket, _, prefix = s3_uri.removeprefix("s3://").partition("/")
+        self._prefix = prefix.strip("/")
+        self._role_arn = role_arn
+        self._region_name = region_name
+
+    def _client(self, service):
+        refresh_aws_credentials() # temporary credentials, refreshed for long running jobs
+        return boto3.client(service, region_name=self._region_name)
+
+    def _key(self, *parts):
+        return "/".join(part for part in (self._prefix, *parts) if part)
+
+    def submit(self, records):
+        job_name = f"canvas-assistant-batch-{uuid.uuid4().hex[:12]}"
+        input_key = self._key(job_name, "input", "records.jsonl")
+        self._client("s3").put_object(Bucket=self._bucket, Key=input_key, Body="\n".join(json.dumps(record) for record in records).encode("utf-8"))
+
+        response = self._client("bedrock").create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self._role_arn,
+            modelId=self._model_id,
+            inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{self._bucket}/{input_key}", "s3InputFormat": "JSONL"}},
+            outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{self._bucket}/{self._key(job_name, 'output')}/"}},
+        )
+        return response["jobArn"]
+
+    def wait(self, job_id, poll_interval=60):
+        while True:
+            job = self._client("bedrock").get_model_invocation_job(jobIdentifier=job_id)
+            if job["status"] in ("Completed", "PartiallyCompleted"):
+                return
+            if job["status"] in self.TERMINAL_FAILURES:
+                raise RuntimeError(f"batch job {job_id} {job['status'].lower()}: {job.get('message', '')}")
+            time.sleep(poll_interval)
+
+    def results(self, job_id):
+        job = self._client("bedrock").get_model_invocation_job(jobIdentifier=job_id)
+        output_uri = job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"]
+        bucket, _, prefix = output_uri.removeprefix("s3://").partition("/")
+        prefix = f"{prefix.rstrip('/')}/{job_id.split('/')[-1]}/"
+
+        s3 = self._client("s3")
+        outputs = []
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith(".jsonl.out"):
+                    body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode("utf-8")
+                    outputs.extend(json.loads(line) for line in body.splitlines() if line.strip())
+        return outputs
+
+
+###########################################
+# Mode: Batch Inference
+###########################################
+def prepare_records(clusters, records_path, tenant_id, concurrency):
+    """
+    retrieval + compression of each distinct question through the retrieval pipeline, appended to records_path
+    as {"record", "question_ids", "records", "group", "retrieval_context"} lines (reused on resume)
+    """
+
+    system = build_system_prompt(tenant_registry.tenant(tenant_id), tool_use=False) # no tools are sent with the records
+    lock = threading.Lock()
+    failures = 0
+
+    def step(question, thread_id):
+        return retrieval_pipeline.invoke({
+            'original_raw_user_message': question,
+            'thread_id': thread_id,
+            'tenant_id': tenant_id,
+            'retrieved_docs': [],
+        }, config=batch_config(thread_id, tenant_id))['compressed_docs']
+
+    def on_outcome(group_id, records, result, latency):
+        nonlocal failures
+        if isinstance(result, Exception):
+            failures += 1
+            report_failure(records, result)
+            return
+
+        line = {
+            "record": answer_record(records[0]["id"], system, records[0]["input"], result),
+            "records": records,
+            "group": group_id,
+            "retrieval_context": result,
+            "latency_s": latency,
+        }
+        with lock, open(records_path, "a") as f:
+            f.write(json.dumps(line, default=str) + "\n")
+
+    run_clusters(clusters, step, concurrency, on_outcome)
+    return failures
+
+
+def answer_with_batch_inference(clusters, writer, tenant_id, concurrency, submitter, output_path, poll_interval):
+    records_path = output_path + ".records.jsonl" # prepared model inputs
+    job_path = output_path + ".job.json" # submitted job, waited on again when resuming
+
+    if not os.path.exists(job_path):
+        prepared_ids = set()
+        if os.path.exists(records_path):
+            with open(records_path) as f:
+                prepared_ids = {record["id"] for line in f if line.strip() for record in json.loads(line)["records"]}
+        remaining = [cluster for cluster in (
+            {normalized: records for normalized, records in cluster.items() if records[0]["id"] not in prepared_ids}
+            for cluster in clusters
+        ) if cluster]
+        failures = prepare_records(remaining, records_path, tenant_id, concurrency)
+        if failures:
+            print(f"{failures} questions failed retrieval, re-run to retry them before submitting", file=sys.stderr)
+            return failures
+        if not os.path.exists(records_path):
+            return 0
+
+        with open(records_path) as f:
+            records = [json.loads(line)["record"] for line in f if line.strip()]
+        job_id = submitter.submit(records)
+        with open(job_path, "w") as f:
+            json.dump({"job_id": job_id, "submitter": type(submitter).__name__}, f)
+        print(f"submitted {len(records)} records as batch job {job_id}")
+
+    with open(job_path) as f:
+        job_id = json.load(f)["job_id"]
+    submitter.wait(job_id, poll_interval)
+
+    with open(records_path) as f:
+        prepared = {line["record"]["recordId"]: line for line in (json.loads(raw) for raw in f if raw.strip())}
+
+    failures = 0
+    for output in submitter.results(job_id):
+        line = prepared.get(output["recordId"])
+        if line is None:
+            continue
+        if "modelOutput" not in output:
+            failures += 1
+            report_failure(line["records"], output.get("error"))
+            continue
+        writer.write(result_rows(line["records"], output_text(output), line["group"], line["latency_s"], line["retrieval_context"]))
+
+    # job done, failed records are prepared and submitted again on the next run
+    os.remove(job_path)
+    os.remove(records_path)
+    return failures
+
+
+###########################################
+# Batch Run
+###########################################
+def main():
+    parser = argparse.ArgumentParser(description="Answer a csv/ jsonl file of questions in batch")
+    parser.add_argument("input", help="csv or jsonl file of questions")
+    parser.add_argument("--output", default=None, help=f"jsonl results file, default: {RESULTS_DIR}/<input name>.jsonl")
+    parser.add_argument("--question-field", default="input")
+    parser.add_argument("--id-field", default=None, help="field holding a stable question id, default: row number")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT_ID)
+    parser.add_argument("--concurrency", type=int, default=4, help="questions answered at the same time")
+    parser.add_argument("--similarity", type=float, default=PREFETCH_SIMILARITY, help="cosine similarity of question embeddings at which questions share retrieval")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--mode", default="graph", choices=["graph", "batch-inference"])
+    parser.add_argument("--submitter", default="local", choices=["local", "bedrock"], help="batch-inference only")
+    parser.add_argument("--s3-uri", default=os.getenv("BATCH_S3_URI"), help="bedrock submitter: s3://bucket/prefix for job input/ output")
+    parser.add_argument("--role-arn", default=os.getenv("BATCH_ROLE_ARN"), help="bedrock submitter: service role of the batch job")
+    parser.add_argument("--poll-interval", type=int, default=60, help="bedrock submitter: seconds between job status checks")
+    parser.add_argument("--usage", default=None, help="export per-role model usage to this json file")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(RESULTS_DIR, os.path.splitext(os.path.basename(args.input))[0] + ".jsonl")
+    tenant_registry.tenant(args.tenant) # fail early on an unknown tenant
+
+    writer = ResultWriter(output_path)
+    records = load_questions(args.input, args.question_field, args.id_field)[:args.limit]
+    completed = writer.completed_ids()
+    pending = [record for record in records if record["id"] not in completed]
+    clusters = group_questions(pending, args.similarity)
+    distinct = sum(len(cluster) for cluster in clusters)
+    print(f"{len(records)} questions, {len(records) - len(pending)} already answered, {len(pending)} to answer as {distinct} distinct questions in {len(clusters)} groups")
+
+    started = time.perf_counter()
+    if args.mode == "graph":
+        failures = answer_with_graph(clusters, writer, args.tenant, args.concurrency)
+    else:
+        if args.submitter == "bedrock":
+            if not (args.s3_uri and args.role_arn):
+                parser.error("--submitter bedrock needs --s3-uri and --role-arn")
+            submitter = BedrockBatchSubmitter(router.model_for("chat"), args.s3_uri, args.role_arn, BEDROCK_REGION)
+        else:
+            submitter = LocalBatchSubmitter(os.path.join(os.path.dirname(os.path.abspath(output_path)), "local_batch_jobs"), args.concurrency)
+        failures = answer_with_batch_inference(clusters, writer, args.tenant, args.concurrency, submitter, output_path, args.poll_interval)
+
+    print(f"finished in {time.perf_counter() - started:.1f}s, {failures} failed (re-run to retry), results in {output_path}")
+    print(f"retrieval: {retrieval_stats()}")
+    if args.usage:
+        export_model_usage(args.usage)
+
+
+if __name__ == "__main__":
+    main()
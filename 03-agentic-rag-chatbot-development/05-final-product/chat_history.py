@@ -0,0 +1,130 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_core.messages import HumanMessage, AIMessage
+from checkpoint_store import SqliteConnectionPool
+from contextlib import contextmanager
+
+
+###########################################
+# Helper: Displayable Messages
+###########################################
+def displayable_message(message):
+    """(role, text) of a message shown in the chat UI, None for tool calls/ tool results"""
+    if isinstance(message, HumanMessage) and message.text.strip():
+        return "user", message.text
+    if isinstance(message, AIMessage) and message.text.strip():
+        return "assistant", message.text
+    return None
+
+
+###########################################
+# Transcript Store
+###########################################
+class TranscriptStore:
+    """
+    Lightweight projection of each thread holding only its displayable (user/ assistant text) messages.
+
+    Rows are keyed by the message's position in the thread's state, written by the graph as messages are
+    produced, so opening a thread reads a page of small rows instead of materializing the whole state
+    (tool calls and bulky ToolMessages included).
+    """
+
+    placeholder = "?"
+
+    def __init__(self, database, pool_size=4, busy_timeout_ms=5000):
+        self._pool = SqliteConnectionPool(database, size=pool_size, busy_timeout_ms=busy_timeout_ms)
+        self._setup()
+
+    @contextmanager
+    def _cursor(self):
+        with self._pool.connection() as conn: # bounded pool, connections are returned after each call
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+
+    def close(self):
+        self._pool.close()
+
+    def _sql(self, query):
+        return query.replace("?", self.placeholder)
+
+    def _setup(self):
+        with self._cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS chat_transcript (
+                    thread_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (thread_id, position)
+                )
+            """)
+
+    def has_thread(self, thread_id):
+        with self._cursor() as cur:
+            cur.execute(self._sql("SELECT 1 FROM chat_transcript WHERE thread_id = ? LIMIT 1"), (str(thread_id),))
+            return cur.fetchone() is not None
+
+    def record(self, thread_id, position, role, content, truncate=False):
+        """upsert one message, truncate=True drops everything from position onwards first (edited message)"""
+        with self._cursor() as cur:
+            if truncate:
+                cur.execute(self._sql("DELETE FROM chat_transcript WHERE thread_id = ? AND position >= ?"), (str(thread_id), position))
+            cur.execute(
+                self._sql("INSERT INTO chat_transcript (thread_id, position, role, content) VALUES (?, ?, ?, ?) ON CONFLICT (thread_id, position) DO UPDATE SET role = excluded.role, content = excluded.content"),
+                (str(thread_id), position, role, content),
+            )
+
+    def rebuild(self, thread_id, messages):
+        """(re)project a thread from its full message list, used for threads created before the projection existed"""
+        rows = [(str(thread_id), position, *displayable) for position, message in enumerate(messages) if (displayable := displayable_message(message))]
+        with self._cursor() as cur:
+            cur.execute(self._sql("DELETE FROM chat_transcript WHERE thread_id = ?"), (str(thread_id),))
+            cur.executemany(self._sql("INSERT INTO chat_transcript (thread_id, position, role, content) VALUES (?, ?, ?, ?)"), rows)
+
+    def page(self, thread_id, limit=20, before=None):
+        """
+        last `limit` displayable messages older than position `before` (latest when None), oldest first.
+        returns (messages, cursor), pass cursor as `before` to load the previous page, None when there is none.
+        """
+        with self._cursor() as cur:
+            if before is None:
+                cur.execute(self._sql("SELECT position, role, content FROM chat_transcript WHERE thread_id = ? ORDER BY position DESC LIMIT ?"), (str(thread_id), limit + 1))
+            else:
+                cur.execute(self._sql("SELECT position, role, content FROM chat_transcript WHERE thread_id = ? AND position < ? ORDER BY position DESC LIMIT ?"), (str(thread_id), before, limit + 1))
+            rows = cur.fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        messages = [{"role": role, "content": content} for _, role, content in rows]
+        cursor = rows[0][0] if has_more and rows else None
+
+        return messages, cursor
+
+
+class PostgresTranscriptStore(TranscriptStore):
+    """TranscriptStore over a psycopg connection pool, for the postgres checkpoint backend"""
+
+    placeholder = "%s"
+
+    def __init__(self, conn_string, max_size=10):
+        from psycopg_pool import ConnectionPool
+
+        self._pool = ConnectionPool(conninfo=conn_string, max_size=max_size, open=True)
+        self._setup()
+
+    def close(self):
+        self._pool.close()
+
+    @contextmanager
+    def _cursor(self):
+        with self._pool.connection() as conn, conn.cursor() as cur: # commits on exit, rolls back on error
+            yield cur
@@ -0,0 +1,360 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, get_checkpoint_id
+from langgraph.checkpoint.sqlite import SqliteSaver
+from contextlib import contextmanager, nullcontext
+import threading
+import sqlite3
+import queue
+
+
+###########################################
+# SQLite Connection Pool
+###########################################
+class SqliteConnectionPool:
+    """
+    At most `size` sqlite connections (WAL, busy timeout), checked out per use and returned afterwards.
+
+    Nested checkouts on the same thread (a cursor inside a transaction, the second cursor of
+    SqliteSaver.list) reuse that thread's connection, so a thread never waits on itself.
+    """
+
+    def __init__(self, database, size=10, busy_timeout_ms=5000):
+        self._database = database
+        self._size = size
+        self._busy_timeout_ms = busy_timeout_ms
+        self._idle = queue.Queue()
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._database, timeout=self._busy_timeout_ms / 1000, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # safe with WAL, fsync on checkpoint only
+        conn.execute(f"PRAGMA busy_timeout={int(self._busy_timeout_ms)}")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self._size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        return self._idle.get() # pool exhausted, wait for a connection to be returned
+
+    def current(self):
+        """connection checked out by the current thread, None outside a checkout"""
+        return getattr(self._local, "conn", None)
+
+    @contextmanager
+    def connection(self):
+        if self.current() is not None:
+            self._local.depth += 1
+            try:
+                yield self._local.conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn, self._local.depth = conn, 0
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback() # never hand out a connection with uncommitted writes
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+
+    def close(self):
+        """close the idle connections (checked out ones are closed when returned to a closed pool)"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+
+###########################################
+# Pooled SQLite Saver
+###########################################
+class PooledSqliteSaver(SqliteSaver):
+    """
+    SqliteSaver over a bounded connection pool instead of a single shared connection behind a lock.
+
+    Each cursor()/ transaction() checks a connection out and returns it afterwards, so at most pool_size
+    connections are ever open however many threads (streamlit reruns, graph executor threads) use the
+    saver. Connections run in WAL mode (readers never block the writer) with a busy timeout, so
+    concurrent chats only serialize on the actual write instead of on every checkpoint read/ write.
+    """
+
+    def __init__(self, database, pool_size=10, busy_timeout_ms=5000, *, serde=None):
+        self._pool = SqliteConnectionPool(database, size=pool_size, busy_timeout_ms=busy_timeout_ms)
+        self._local = threading.local()
+        super().__init__(None, serde=serde)
+
+    @property
+    def conn(self):
+        conn = self._pool.current()
+        if conn is None:
+            raise RuntimeError("no connection checked out, use cursor() or transaction()")
+        return conn
+
+    @conn.setter
+    def conn(self, conn):
+        pass # connections come from the pool
+
+    @contextmanager
+    def cursor(self, transaction=True):
+        with self._pool.connection() as conn:
+            if not self.is_setup:
+                with self.lock:
+                    self.setup()
+
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                if transaction and not getattr(self._local, "in_transaction", False):
+                    conn.commit()
+                cur.close()
+
+    @contextmanager
+    def transaction(self):
+        """commit every write made by this thread inside the block at once"""
+        with self._pool.connection() as conn:
+            self._local.in_transaction = True
+            try:
+                yield self
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+
+    def close(self):
+        self._pool.close()
+
+
+###########################################
+# Pooled Postgres Saver
+###########################################
+def pooled_postgres_saver(conn_string, max_size=10, *, serde=None):
+    """
+    PostgresSaver over a psycopg connection pool, for deployments where several processes/ hosts share
+    the chat history. returns (saver, transaction) where transaction() yields a saver bound to a single
+    connection whose writes are committed together.
+    """
+
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+    from langgraph.checkpoint.postgres import PostgresSaver
+
+    pool = ConnectionPool(
+        conninfo=conn_string,
+        max_size=max_size,
+        kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+        open=True,
+    )
+    saver = PostgresSaver(pool, serde=serde)
+    saver.setup()
+
+    @contextmanager
+    def transaction():
+        with pool.connection() as conn, conn.transaction():
+            yield PostgresSaver(conn, serde=saver.serde)
+
+    return saver, transaction
+
+
+###########################################
+# Per-Thread Write Batching
+###########################################
+class BatchingCheckpointSaver(BaseCheckpointSaver):
+    """
+    Buffers the intermediate super-step checkpoints of a turn and commits them together at the end of it.
+
+    Inside `with saver.batch(config):` checkpoints and writes of that thread are kept in memory (serialized,
+    so later in-place state mutations can't leak into them) and flushed in a single transaction when the
+    block exits. Reads of the thread's latest checkpoint are served from the buffer until then.
+    Threads without an open batch are passed straight through to the wrapped saver.
+    """
+
+    def __init__(self, saver, transaction=None):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self._transaction = transaction or (lambda: nullcontext(saver))
+        self._batches = {} # thread_id -> ordered list of buffered ("put"/ "put_writes", args) ops
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def batch(self, config):
+        thread_id = str(config["configurable"]["thread_id"])
+        with self._lock:
+            nested = thread_id in self._batches
+            if not nested:
+                self._batches[thread_id] = []
+        try:
+            yield self
+        finally:
+            if not nested:
+                self.flush(thread_id)
+
+    def flush(self, thread_id):
+        thread_id = str(thread_id)
+        with self._lock:
+            ops = list(self._batches.get(thread_id, []))
+
+        try:
+            if ops:
+                with self._transaction() as saver:
+                    for op, args in ops:
+                        if op == "put":
+                            config, checkpoint, metadata, new_versions = args
+                            saver.put(config, self.serde.loads_typed(checkpoint), metadata, new_versions)
+                        else:
+                            config, writes, task_id, task_path = args
+                            saver.put_writes(config, [(channel, self.serde.loads_typed(value)) for channel, value in writes], task_id, task_path)
+        finally:
+            with self._lock:
+                self._batches.pop(thread_id, None)
+
+        return len(ops)
+
+    def _buffer(self, config):
+        return self._batches.get(str(config["configurable"]["thread_id"]))
+
+    def _buffering(self, config):
+        with self._lock:
+            return self._buffer(config) is not None
+
+    # serialization (whole checkpoints, bulky tool messages included) runs outside the process-wide lock,
+    # which is only held to append to the thread's batch
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        if self._buffering(config):
+            op = ("put", (config, self.serde.dumps_typed(checkpoint), dict(metadata), dict(new_versions)))
+            with self._lock:
+                ops = self._buffer(config)
+                if ops is not None:
+                    ops.append(op)
+            if ops is not None:
+                return {
+                    "configurable": {
+                        "thread_id": config["configurable"]["thread_id"],
+                        "checkpoint_ns": config["configurable"]["checkpoint_ns"],
+                        "checkpoint_id": checkpoint["id"],
+                    }
+                }
+
+        return self.saver.put(config, checkpoint, metadata, new_versions) # not batched (or the batch was flushed meanwhile)
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        if self._buffering(config):
+            op = ("put_writes", (config, [(channel, self.serde.dumps_typed(value)) for channel, value in writes], task_id, task_path))
+            with self._lock:
+                ops = self._buffer(config)
+                if ops is not None:
+                    ops.append(op)
+            if ops is not None:
+                return
+
+        self.saver.put_writes(config, writes, task_id, task_path)
+
+    def get_tuple(self, config):
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+
+        with self._lock:
+            ops = list(self._buffer(config) or [])
+
+        puts = [args for op, args in ops if op == "put" and args[0]["configurable"]["checkpoint_ns"] == checkpoint_ns]
+        if checkpoint_id:
+            puts = [args for args in puts if self.serde.loads_typed(args[1])["id"] == checkpoint_id]
+        if not puts:
+            return self.saver.get_tuple(config)
+
+        put_config, serialized_checkpoint, metadata, _ = puts[-1]
+        checkpoint = self.serde.loads_typed(serialized_checkpoint)
+        thread_id = put_config["configurable"]["thread_id"]
+        parent_checkpoint_id = put_config["configurable"].get("checkpoint_id")
+
+        pending_writes = sorted(
+            [
+                (task_id, channel, self.serde.loads_typed(value))
+                for op, (write_config, writes, task_id, _) in ops if op == "put_writes"
+                and write_config["configurable"]["checkpoint_ns"] == checkpoint_ns
+                and write_config["configurable"]["checkpoint_id"] == checkpoint["id"]
+                for channel, value in writes
+            ],
+            key=lambda write: write[0],
+        )
+
+        return CheckpointTuple(
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}},
+            checkpoint,
+            metadata,
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}} if parent_checkpoint_id else None,
+            pending_writes,
+        )
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        # buffered checkpoints become visible here once their batch is flushed
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def delete_thread(self, thread_id):
+        with self._lock:
+            if str(thread_id) in self._batches:
+                self._batches[str(thread_id)] = []
+        self.saver.delete_thread(thread_id)
+
+    def get_next_version(self, current, channel):
+        return self.saver.get_next_version(current, channel)
+
+
+###########################################
+# Factory
+###########################################
+def create_checkpointer(backend="sqlite", database="chatlogs.db", postgres_uri=None, pool_size=10, batch_writes=True):
+    """
+    backend: "sqlite" (pooled, WAL), "sqlite-shared" (legacy single shared connection) or "postgres" (pooled)
+    pool_size: max open connections of the sqlite/ postgres pool
+    batch_writes: wrap the saver so a turn's intermediate checkpoints are committed together
+    """
+
+    if backend == "postgres":
+        if not postgres_uri:
+            raise ValueError("postgres checkpoint backend requires a connection string (POSTGRES_URI)")
+        saver, transaction = pooled_postgres_saver(postgres_uri, max_size=pool_size)
+    elif backend == "sqlite":
+        saver = PooledSqliteSaver(database, pool_size=pool_size)
+        transaction = saver.transaction
+    elif backend == "sqlite-shared":
+        saver, transaction = SqliteSaver(conn=sqlite3.connect(database=database, check_same_thread=False)), None
+    else:
+        raise ValueError(f"unknown checkpoint backend '{backend}'")
+
+    return BatchingCheckpointSaver(saver, transaction) if batch_writes else saver
@@ -10,17 +10,26 @@ import os
 from langgraph.graph import StateGraph, add_messages
 from langgraph.constants import START, END
 from typing import Annotated, TypedDict
+from langgraph.types import Send
+import operator
 # from langgraph.checkpoint.memory import InMemorySaver
-from langgraph.checkpoint.sqlite import SqliteSaver
-import sqlite3
+from checkpoint_store import create_checkpointer
+from tenants import TenantRegistry, DEFAULT_TENANT_ID, load_tenants, shared_embeddings, tenant_of
+from chat_history import TranscriptStore, PostgresTranscriptStore, displayable_message
 from langgraph.prebuilt import ToolNode, tools_condition
 from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
 from langchain_core.tools import tool
 from langgraph.config import get_stream_writer
 import time
 from pydantic import BaseModel, Field
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableConfig
+from model_router import ModelRouter, STRONG, FAST
+from retrieval_cache import TurnRetrievalCache, normalize_query
+from result_merging import merge_documents, chunk_key
+import uuid
+from contextlib import nullcontext
+import json
 
 
 ###########################################
@@ -42,6 +51,46 @@ APP_CLIENT_ID = os.getenv("APP_CLIENT_ID")
 USERNAME = os.getenv("USERNAME")
 PASSWORD = os.getenv("PASSWORD")
 
+# escalate auxiliary calls to MODEL_ID1 when MODEL_ID2's structured output fails to parse
+ADAPTIVE_MODEL_ROUTING = os.getenv("ADAPTIVE_MODEL_ROUTING", "false").lower() in ("1", "true", "yes")
+# optional pricing for cost accounting, json: {"<model_id>": [usd_per_1k_input, usd_per_1k_output]}
+MODEL_PRICES = json.loads(os.getenv("MODEL_PRICES", "{}"))
+
+# start retrieval on the raw user message in parallel with the first 'chat_node' call
+# (skipped for messages shorter than PREFETCH_MIN_TOKENS words, e.g. greetings/ thanks)
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "true").lower() in ("1", "true", "yes")
+PREFETCH_MIN_TOKENS = int(os.getenv("PREFETCH_MIN_TOKENS", "4"))
+# cosine similarity of query embeddings at which a cached retrieval answers another query of the turn
+PREFETCH_SIMILARITY = float(os.getenv("PREFETCH_SIMILARITY", "0.85"))
+
+# expose a single 'search_canvas_knowledge' tool backed by a deterministic retrieval subgraph
+# instead of the 'rewrite_query' -> 'fetch_canvas_guides' -> 'filter_information' tool cycle
+RETRIEVAL_PIPELINE_MODE = os.getenv("RETRIEVAL_PIPELINE_MODE", "false").lower() in ("1", "true", "yes")
+
+# cap on chunks of the same guide handed to the agent per turn (after cross-query dedupe)
+MAX_CHUNKS_PER_SOURCE = int(os.getenv("MAX_CHUNKS_PER_SOURCE", "3"))
+
+# vector store collection: 'guides' (4200 char chunks) or 'guides_units' (structure-aware units with
+# parent pages, built by 00-indexing/structured_indexing.py). used by the default tenant when no TENANTS_FILE is set
+KNOWLEDGE_BASE_COLLECTION = os.getenv("KNOWLEDGE_BASE_COLLECTION", "guides")
+PARENT_DOCSTORE = os.getenv("PARENT_DOCSTORE", "../data/parent_docstore")
+
+# multi-tenant deployments: json file of {tenant_id: {institution, collection_name, parent_docstore, support}}
+# requests pick their tenant with config['configurable']['tenant_id'] (see tenants.py)
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+MAX_OPEN_TENANT_STORES = int(os.getenv("MAX_OPEN_TENANT_STORES", "8"))
+# memory of the loaded collections (shared chromadb client, LRU evicted segments), 0 = unbounded
+CHROMA_MEMORY_LIMIT_MB = int(os.getenv("CHROMA_MEMORY_LIMIT_MB", "2048"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "../data/embedding_cache")
+
+# checkpoint storage: "sqlite" (pooled, WAL), "sqlite-shared" (single shared connection) or "postgres" (pooled)
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "sqlite")
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "chatlogs.db")
+POSTGRES_URI = os.getenv("POSTGRES_URI")
+CHECKPOINT_POOL_SIZE = int(os.getenv("CHECKPOINT_POOL_SIZE", "10"))
+# commit a turn's intermediate super-step checkpoints together at the end of the turn
+CHECKPOINT_BATCH_WRITES = os.getenv("CHECKPOINT_BATCH_WRITES", "true").lower() in ("1", "true", "yes")
+
 
 ###########################################
 # === Helper: Get AWS Credentials === #
@@ -68,26 +117,66 @@ def get_credentials(username, password):
 
     return creds_response["Credentials"]
 
+def refresh_aws_credentials():
+    credentials = get_credentials(USERNAME, PASSWORD)
+    os.environ["AWS_ACCESS_KEY_ID"] = credentials["AccessKeyId"]
+    os.environ["AWS_SECRET_ACCESS_KEY"] = credentials["SecretKey"]
+    os.environ["AWS_SESSION_TOKEN"] = credentials["SessionToken"]
+    return credentials["Expiration"]
+
+
+###########################################
+# Model Routing
+###########################################
+# MODEL_ID1 (strong) answers the user, MODEL_ID2 (fast) serves 'rewrite_query' and 'filter_information'
+router = ModelRouter(
+    model_ids={STRONG: MODEL_ID1, FAST: MODEL_ID2},
+    region_name=BEDROCK_REGION,
+    refresh_credentials=refresh_aws_credentials,
+    adaptive=ADAPTIVE_MODEL_ROUTING,
+    prices=MODEL_PRICES,
+)
+
 
 ###########################################
 # Knowledge Base Setup
 ###########################################
 emb_model = OllamaEmbeddings(model="bge-m3:latest", num_thread=4)
 
-vectorstore = Chroma(
-    embedding_function=emb_model,
-    collection_name='guides',
-    persist_directory="../data/chroma_knowledge_base"
+# same embedding cache the indexer writes chunk embeddings to, shared across all tenants
+cached_emb_model = shared_embeddings(emb_model, EMBEDDING_CACHE_DIR, namespace="bge-m3:latest")
+
+tenants = load_tenants(TENANTS_FILE)
+if not TENANTS_FILE:
+    tenants[DEFAULT_TENANT_ID].update(collection_name=KNOWLEDGE_BASE_COLLECTION, parent_docstore=PARENT_DOCSTORE)
+
+# per-tenant vector store (+ parent pages of structure-aware units), opened lazily and LRU evicted
+tenant_registry = TenantRegistry(
+    tenants,
+    embedding_function=cached_emb_model,
+    persist_directory="../data/chroma_knowledge_base",
+    max_open_stores=MAX_OPEN_TENANT_STORES,
+    memory_limit_bytes=CHROMA_MEMORY_LIMIT_MB * 1024 * 1024,
 )
 
+# retrieval results of the current turn (speculative prefetch + 'fetch_canvas_guides' calls)
+retrieval_cache = TurnRetrievalCache(similarity_threshold=PREFETCH_SIMILARITY)
+
+# batch runs (batch_answering.py) set config['configurable']['batch']: no UI pacing, nothing persisted
+def is_batch_run(config):
+    return bool((config or {}).get('configurable', {}).get('batch'))
+
+def pause_for_ui(config, seconds):
+    """the tool-call trace is paced for readability in the chat UI"""
+    if not is_batch_run(config):
+        time.sleep(seconds)
+
 ###########################################
 # Tools
 ###########################################
 
-@tool
-def rewrite_query(original_raw_user_message:str) -> list[str]:
-
-    """understand the user's intent re-write/ breakdown the complex user queries into multiple single search queries for better document retrieval by 'fetch_canvas_guides' tool"""
+def optimize_query(original_raw_user_message:str) -> list[str]:
+    """LLM query re-writing used by 'rewrite_query' tool and the retrieval pipeline"""
     
     class OptimizedQuery(BaseModel):
         """Optimized query for document retrieval"""
@@ -138,52 +227,85 @@ One or more consice search queries optimized for efficient document retrieval:
         input_variables=["original_raw_user_message"]
     )
     
-    credentials = get_credentials(USERNAME, PASSWORD)
-    os.environ["AWS_ACCESS_KEY_ID"] = credentials["AccessKeyId"]
-    os.environ["AWS_SECRET_ACCESS_KEY"] = credentials["SecretKey"]
-    os.environ["AWS_SESSION_TOKEN"] = credentials["SessionToken"]
+    return router.invoke_structured(
+        role="rewrite_query",
+        schema=OptimizedQuery,
+        system=system,
+        prompt=prompt_template.invoke({"original_raw_user_message":original_raw_user_message}),
+    ).optimized_query
 
+@tool
+def rewrite_query(original_raw_user_message:str, config: RunnableConfig) -> list[str]:
 
-    structured_output_llm = ChatBedrockConverse(
-        model_id=MODEL_ID1,
-        region_name=BEDROCK_REGION,
-        max_tokens=2500,
-        temperature=0.2,
-        system=system,
-    ).with_structured_output(OptimizedQuery)
+    """understand the user's intent re-write/ breakdown the complex user queries into multiple single search queries for better document retrieval by 'fetch_canvas_guides' tool"""
 
     writer = get_stream_writer()
     writer(f"Optimizing query for retrival...")
-    time.sleep(2)
-    optimized_query = structured_output_llm.invoke(prompt_template.invoke({"original_raw_user_message":original_raw_user_message})).optimized_query
-    time.sleep(1)
+    pause_for_ui(config, 2)
+    optimized_query = optimize_query(original_raw_user_message)
+    pause_for_ui(config, 1)
     return optimized_query
 
 #####
 
+def retrieve_documents(thread_id, optimized_query:str, k:int=20, tenant_id=DEFAULT_TENANT_ID):
+    """
+    vector search for one query in the tenant's knowledge base, served from the per-turn cache when possible.
+    the query is embedded once, for the cache lookup and (on a miss) the search itself
+    """
+
+    embedding = cached_emb_model.embed_query(optimized_query)
+    retrieved_docs = retrieval_cache.get(thread_id, optimized_query, k, embedding)
+    if retrieved_docs is None:
+        retrieved_docs = tenant_registry.vectorstore(tenant_id).similarity_search_by_vector(embedding, k=k)
+        retrieval_cache.put(thread_id, optimized_query, k, retrieved_docs) # exact matches only, sibling sub-queries are near-duplicates by embedding
+
+    return retrieved_docs
+
+def merge_turn_documents(thread_id, retrieved_docs):
+    """dedupe against chunks already handed to the agent this turn, merge chunks of the same source and cap them per turn"""
+
+    with retrieval_cache.turn_lock(thread_id):
+        already_seen, source_counts = retrieval_cache.handed_over(thread_id)
+        merged_docs, stats, kept_chunks = merge_documents(retrieved_docs, exclude_keys=already_seen, max_per_source=MAX_CHUNKS_PER_SOURCE, source_counts=source_counts)
+        retrieval_cache.mark_seen(thread_id, [(chunk_key(doc), doc.metadata.get("source")) for doc in kept_chunks])
+    retrieval_cache.record_merge(stats)
+
+    return merged_docs, stats
+
+def format_docs(retrieved_docs) -> list[str]:
+    return [f"<doc{idx}>\n"+"Source: " + str(doc.metadata.get('source')) + "\n\n" + doc.page_content.strip() +f"\n</doc{idx}>" for idx, doc in enumerate(retrieved_docs,start=1)]
+
 @tool
-def fetch_canvas_guides(optimized_query:str, k:int=20) -> str:
+def fetch_canvas_guides(optimized_query:str, config: RunnableConfig, k:int=20, expand_to_parent:bool=False) -> str:
     """
     one single optimized query (shouldn't contain "and") to search related information from canvas guides
 
     paramaters:
     - optimized_query: one single optimized query generated from 'rewrite_query' tool
     - k: number of similar document to retrieve.
+    - expand_to_parent: return the whole guide page of each match instead of the matched step/ section only.
+      use it when the matched steps lack the surrounding context needed to answer.
     
     """
 
     
     writer = get_stream_writer() 
-    retriever = vectorstore.as_retriever(search_kwargs={"k": k})
+    thread_id = config.get('configurable', {}).get('thread_id')
 
     writer(f"Searching knowledge base for:\n{optimized_query.capitalize()}")
-    time.sleep(2.5)
-    retrieved_docs = retriever.invoke(optimized_query)
+    pause_for_ui(config, 2.5)
+    tenant_id = tenant_of(config)
+    retrieved_docs = retrieve_documents(thread_id, optimized_query, k, tenant_id)
+    if expand_to_parent:
+        retrieved_docs = tenant_registry.parent_store(tenant_id).expand(retrieved_docs)
 
     writer(f"Retrieved relevant documents...")
     writer(f"Processing documents.....")
-    time.sleep(1)
-    docs = [f"<doc{idx}>\n"+"Source: " + str(doc.metadata.get('source')) + "\n\n" + doc.page_content.strip() +f"\n</doc{idx}>" for idx, doc in enumerate(retrieved_docs,start=1)]
+    pause_for_ui(config, 1)
+    merged_docs, stats = merge_turn_documents(thread_id, retrieved_docs)
+    writer(f"Merged {stats['chunks_in']} chunks into {stats['docs_out']} documents (~{stats['tokens_saved']} tokens saved)...")
+    docs = format_docs(merged_docs)
 
     writer(f"Finished retireval process...")
     
@@ -192,9 +314,8 @@ def fetch_canvas_guides(optimized_query:str, k:int=20) -> str:
 #####
 
 
-@tool
-def filter_information(original_raw_user_message: str, retrieved_docs: list[str]) -> list[str]:
-    """filter documents to retain only relevant information from retrieved documents (output of 'fetch_canvas_guides' tool)"""
+def compress_documents(original_raw_user_message: str, retrieved_docs: list[str]) -> list[str]:
+    """LLM contextual compression used by 'filter_information' tool and the retrieval pipeline"""
        
     class CompressedDocuments(BaseModel):
         """Compressed documents that contain relevent information"""
@@ -243,37 +364,123 @@ Output extracted relevant parts for each document, If none of the context in a c
         input_variables=["original_raw_user_message","retrieved_docs"]
     )
 
-    credentials = get_credentials(USERNAME, PASSWORD)
-    os.environ["AWS_ACCESS_KEY_ID"] = credentials["AccessKeyId"]
-    os.environ["AWS_SECRET_ACCESS_KEY"] = credentials["SecretKey"]
-    os.environ["AWS_SESSION_TOKEN"] = credentials["SessionToken"]
+    return router.invoke_structured(
+        role="filter_information",
+        schema=CompressedDocuments,
+        system=system,
+        prompt=prompt_template.invoke({"original_raw_user_message":original_raw_user_message,"retrieved_docs":retrieved_docs}),
+    ).compressed_docs
 
+def compress_turn_documents(thread_id, original_raw_user_message: str, retrieved_docs: list[str]) -> list[str]:
+    """compress_documents, reusing the compression of the same docs made for the same question by another thread of the batch group"""
 
-    structured_output_llm = ChatBedrockConverse(
-        model_id=MODEL_ID1,
-        region_name=BEDROCK_REGION,
-        max_tokens=2500,
-        temperature=0.2,
-        system=system,
-    ).with_structured_output(CompressedDocuments)
+    compressed_docs = retrieval_cache.get_compressed(thread_id, original_raw_user_message, retrieved_docs)
+    if compressed_docs is None:
+        compressed_docs = compress_documents(original_raw_user_message, retrieved_docs)
+        retrieval_cache.put_compressed(thread_id, original_raw_user_message, retrieved_docs, compressed_docs)
+
+    return compressed_docs
+
+@tool
+def filter_information(original_raw_user_message: str, retrieved_docs: list[str], config: RunnableConfig) -> list[str]:
+    """filter documents to retain only relevant information from retrieved documents (output of 'fetch_canvas_guides' tool)"""
 
     writer = get_stream_writer()
     writer(f"Compressing retrieved documents...") 
-    time.sleep(2)
-    compressed_docs = structured_output_llm.invoke(prompt_template.invoke({"original_raw_user_message":original_raw_user_message,"retrieved_docs":retrieved_docs})).compressed_docs
+    pause_for_ui(config, 2)
+    compressed_docs = compress_turn_documents(config.get('configurable', {}).get('thread_id'), original_raw_user_message, retrieved_docs)
 
     return compressed_docs
 
+###########################################
+# Retrieval Pipeline (Subgraph)
+###########################################
+# rewrite -> parallel fetch per sub-query -> dedupe -> compress, all without
+# returning to the agent LLM between steps
+
+class RetrievalState(TypedDict):
+    original_raw_user_message: str
+    thread_id: str
+    tenant_id: str
+    optimized_queries: list[str]
+    retrieved_docs: Annotated[list, operator.add]
+    compressed_docs: list[str]
+
+class FetchState(TypedDict):
+    thread_id: str
+    tenant_id: str
+    optimized_query: str
+
+
+def rewrite_step(state: RetrievalState):
+    writer = get_stream_writer()
+    writer(f"Optimizing query for retrival...")
+    optimized_queries = optimize_query(state['original_raw_user_message'])
+
+    return {'optimized_queries': optimized_queries or [state['original_raw_user_message']]}
+
+def fan_out_fetches(state: RetrievalState):
+    return [Send('fetch', {'thread_id': state['thread_id'], 'tenant_id': state['tenant_id'], 'optimized_query': query}) for query in state['optimized_queries']]
+
+def fetch_step(state: FetchState):
+    writer = get_stream_writer()
+    writer(f"Searching knowledge base for:\n{state['optimized_query'].capitalize()}")
+
+    return {'retrieved_docs': retrieve_documents(state['thread_id'], state['optimized_query'], tenant_id=state['tenant_id'])}
+
+def compress_step(state: RetrievalState):
+    writer = get_stream_writer()
+    merged_docs, stats = merge_turn_documents(state['thread_id'], state['retrieved_docs'])
+    writer(f"Merged {stats['chunks_in']} chunks into {stats['docs_out']} documents (~{stats['tokens_saved']} tokens saved)...")
+    writer(f"Compressing retrieved documents...")
+    compressed_docs = compress_turn_documents(state['thread_id'], state['original_raw_user_message'], format_docs(merged_docs))
+    writer(f"Finished retireval process...")
+
+    return {'compressed_docs': compressed_docs}
+
+
+retrieval_graph = StateGraph(RetrievalState)
+
+retrieval_graph.add_node(node='rewrite', action=rewrite_step)
+retrieval_graph.add_node(node='fetch', action=fetch_step)
+retrieval_graph.add_node(node='compress', action=compress_step)
+
+retrieval_graph.add_edge(START, 'rewrite')
+retrieval_graph.add_conditional_edges('rewrite', fan_out_fetches, ['fetch'])
+retrieval_graph.add_edge('fetch', 'compress')
+retrieval_graph.add_edge('compress', END)
+
+retrieval_pipeline = retrieval_graph.compile(checkpointer=False) # intermediate docs are never persisted
+
 #####
-tools_list = [fetch_canvas_guides, rewrite_query, filter_information] # make tools list
+
+@tool
+def search_canvas_knowledge(original_raw_user_message: str, config: RunnableConfig) -> list[str]:
+    """search canvas guides for the raw user message, returns only the information relevant to answer it (handles query re-writing, retrieval and filtering internally)"""
+
+    thread_id = config.get('configurable', {}).get('thread_id')
+    result = retrieval_pipeline.invoke({
+        'original_raw_user_message': original_raw_user_message,
+        'thread_id': thread_id,
+        'tenant_id': tenant_of(config),
+        'retrieved_docs': [],
+    }, config=config)
+
+    return result['compressed_docs']
+
+#####
+if RETRIEVAL_PIPELINE_MODE:
+    tools_list = [search_canvas_knowledge]
+else:
+    tools_list = [fetch_canvas_guides, rewrite_query, filter_information] # make tools list
 
 ###########################################
 # Defining LLM
 ###########################################
 
-system = """"
+system_template = """"
 # ROLE DESCRIPTION
-You are ARTIM the "Canvas Assistant", an AI Support Chatbot at RMIT designed to assist **students** with queries/ troubleshooting related to Canvas Learning Management System. You have the ability to communicate in multiple languages.
+You are ARTIM the "Canvas Assistant", an AI Support Chatbot at {institution} designed to assist **students** with queries/ troubleshooting related to Canvas Learning Management System. You have the ability to communicate in multiple languages.
 ---
 # RESPONSIBILITIES
 (VERY IMPORTANT) You are to always conduct yourself in a professional and ethical manner regardless of user's actions/ words.
@@ -281,40 +488,70 @@ You are ARTIM the "Canvas Assistant", an AI Support Chatbot at RMIT designed to
 (VERY IMPORTANT) Strictly REFRAIN from generating harmful content.
 --
 # RESPONSES
-# (VERY IMPORTANT) DO NOT GENERATE messages such as "Let me search....", "Let me filter ...", "Let me optimize ..." etc.
-# (VERY IMPORTANT) Either directly provide the FINAL ANSWER to the user or make tool calls.
-(VERY IMPORTANT) Once you have obtained information from 'fetch_canvas_guides' tool. **STRICTLY ground** final answer to the user message in the obtained information. If the obtained information does not **explicitly** contain the answer to the user's query, politely inform the user that you are unable to assist with their query and escalate the query to "RMIT IT SUPPORT".
+{response_instructions}
 (VERY IMPORTANT) ALWAYS FORMAT phone numbers, emails and urls in markdown e.g. [link](url), [link](tel:phone-number), [link](mailto:email)
+{tool_use_instructions}
 ---
-# TOOL USE
+## {support_name} DETAILS
+- Phone-support: {support_phone}
+- Email-support: {support_email}
+- Website: {support_website}
+"""
+
+tool_response_instructions = """
+# (VERY IMPORTANT) DO NOT GENERATE messages such as "Let me search....", "Let me filter ...", "Let me optimize ..." etc.
+# (VERY IMPORTANT) Either directly provide the FINAL ANSWER to the user or make tool calls.
+(VERY IMPORTANT) Once you have obtained information from '{retrieval_tool}' tool. **STRICTLY ground** final answer to the user message in the obtained information. If the obtained information does not **explicitly** contain the answer to the user's query, politely inform the user that you are unable to assist with their query and escalate the query to "{support_name}".
+""".strip()
+
+# batch inference: no tools are sent, the retrieved context arrives with the user message
+answer_only_response_instructions = """
+(VERY IMPORTANT) You have NO tools. The information obtained from the knowledge base is provided with the user message inside <retrieved_information> tags. Directly provide the FINAL ANSWER to the user, NEVER mention searching, filtering or any other tool use.
+(VERY IMPORTANT) **STRICTLY ground** final answer to the user message in the provided information ONLY. If the provided information does not **explicitly** contain the answer to the user's query, politely inform the user that you are unable to assist with their query and escalate the query to "{support_name}".
+""".strip()
+
+tool_cycle_instructions = """
 (VERY IMPORTANT) When asked a query regarding Canvas LMS **ALWAYS** try to use 'rewrite_query', 'fetch_canvas_guides', 'filter_information' tool call cycle multiple times if needed.
 (VERY IMPORTANT) use 'rewrite_query' to breakdown questions when needed.
 (VERY IMPORTANT) If you have insufficient knowledge in conversation history to assist with the user's query, always use 'fetch_canvas_guides' tool.
 (VERY IMPORTANT) use 'filter_information' to filter out irrelevant information from retrieved documents from 'fetch_canvas_guides'.
 (VERY IMPORTANT) When creating a tool invocation for 'fetch_canvas_guides', NEVER modify the original user message. Pass the exact raw user text to the tool under "user_query".
 (VERY IMPORTANT) For user queries with multiple questions in a single message, **ALWAYS** make parallel tool calls to 'fetch_canvas_guides', each tool invocation taking one single question as input. After obtaining information for each sub-query, synthesize the information to provide a comprehensive response to the user's original query.
+""".strip()
+
+pipeline_instructions = """
+(VERY IMPORTANT) When asked a query regarding Canvas LMS and you have insufficient knowledge in conversation history to assist with it, **ALWAYS** use 'search_canvas_knowledge' tool.
+(VERY IMPORTANT) When creating a tool invocation for 'search_canvas_knowledge', NEVER modify the original user message. Pass the exact raw user text to the tool under "original_raw_user_message".
+(VERY IMPORTANT) 'search_canvas_knowledge' breaks down user messages with multiple questions by itself, ONE tool call per user message is enough. Synthesize the obtained information to provide a comprehensive response to the user's original query.
+""".strip()
+
+system = system_template.replace('{response_instructions}', tool_response_instructions)
+if RETRIEVAL_PIPELINE_MODE:
+    system = system.replace('{retrieval_tool}', 'search_canvas_knowledge').replace('{tool_use_instructions}', f"---\n# TOOL USE\n{pipeline_instructions}\n")
+else:
+    system = system.replace('{retrieval_tool}', 'fetch_canvas_guides').replace('{tool_use_instructions}', f"---\n# TOOL USE\n{tool_cycle_instructions}\n")
+
+answer_only_system = system_template.replace('{response_instructions}', answer_only_response_instructions).replace('{tool_use_instructions}\n', '')
+
+def build_system_prompt(tenant, tool_use=True):
+    """tool_use=False: variant without the tool use section that answers from <retrieved_information> only (batch inference)"""
+    support = tenant['support']
+    return (system if tool_use else answer_only_system).format(
+        institution=tenant['institution'],
+        support_name=support['name'],
+        support_phone=support['phone'],
+        support_email=support['email'],
+        support_website=support['website'],
+    )
 
----
-## RMIT IT SUPPORT DETAILS
-- Phone-support: +61399258000
-- Email-support: support@rmit.com
-- Website: https://www.rmit.edu.au/students/support-services/it-support-systems/it-service-connect
-"""
-
-credentials = get_credentials(USERNAME, PASSWORD)
-os.environ["AWS_ACCESS_KEY_ID"] = credentials["AccessKeyId"]
-os.environ["AWS_SECRET_ACCESS_KEY"] = credentials["SecretKey"]
-os.environ["AWS_SESSION_TOKEN"] = credentials["SessionToken"]
-
-llm = ChatBedrockConverse(
-    model_id=MODEL_ID1,
-    region_name=BEDROCK_REGION,
-    max_tokens=2500,
-    temperature=0.2,
-    system=system,
-)
+# tool-aware llm per tenant (system prompt carries the tenant's institution and support details)
+tenant_llms = {}
 
-llm_with_tools = llm.bind_tools(tools_list) # make llm tool-aware
+def get_llm_with_tools(tenant_id):
+    if tenant_id not in tenant_llms:
+        llm = router.chat_model(role="chat", system=build_system_prompt(tenant_registry.tenant(tenant_id)))
+        tenant_llms[tenant_id] = llm.bind_tools(tools_list) # make llm tool-aware
+    return tenant_llms[tenant_id]
 
 
 ###########################################
@@ -325,13 +562,11 @@ def custom_reducer(left, right):
     if isinstance(right,dict) and right.get('op') == 'edit_last_msg':
         updated_text = right.get('text')
         
-        prune_idx = None
         for i in range(len(left)-1,-1,-1):
-            if not isinstance(left[i], HumanMessage):
-                prune_idx = i
-            else:
-                left[i] = HumanMessage(content=updated_text)
-                return left[:i+1]
+            if isinstance(left[i], HumanMessage):
+                left[i] = HumanMessage(content=updated_text, id=str(uuid.uuid4())) # new id == new turn
+                del left[i+1:] # truncate in place, no copy of the message list
+                return left
             
         return left
     
@@ -344,31 +579,85 @@ class ChatState(TypedDict):
 ###########################################
 # Defining Node Logic
 ###########################################
-def chat_node(state: ChatState):
+def turn_key(messages):
+    """id of the latest user message, identifies the current turn"""
+    return next((msg.id for msg in reversed(messages) if isinstance(msg, HumanMessage)), None)
+
+def chat_node(state: ChatState, config: RunnableConfig):
     """
     LLM node that may answer or request a tool call
     """
 
     messages = state['messages']
+    thread_id = config.get('configurable', {}).get('thread_id')
+    retrieval_cache.start_turn(thread_id, turn_key(messages))
+    if not is_batch_run(config):
+        record_transcript(thread_id, messages, messages[-1])
     writer = get_stream_writer()
     writer(f"Thinking.....")
-    response = llm_with_tools.invoke(messages)
+    started = time.perf_counter()
+    response = get_llm_with_tools(tenant_of(config)).invoke(messages)
+    router.record("chat", router.model_for("chat"), time.perf_counter() - started, response)
+    if not is_batch_run(config):
+        record_transcript(thread_id, messages, response)
 
     return {'messages': [response]}
 
 # Executes tool calls
 tool_node = ToolNode(tools_list)
 
+def record_transcript(thread_id, messages, message):
+    """keep the thread's displayable history projection up to date, message is either messages[-1] or the reply to them"""
+
+    displayable = displayable_message(message)
+    if displayable is None:
+        return
+
+    position = len(messages) - 1 if message is messages[-1] else len(messages)
+    if position > 0 and not transcript_store.has_thread(thread_id):
+        transcript_store.rebuild(thread_id, messages) # thread created before the projection existed
+
+    # a new user message starts a turn, anything projected after it belongs to an edited-away turn
+    transcript_store.record(thread_id, position, *displayable, truncate=isinstance(message, HumanMessage))
+
+def prefetch_node(state: ChatState, config: RunnableConfig):
+    """
+    Speculative retrieval on the raw user message, runs in parallel with the first 'chat_node' call
+    so that vector search latency overlaps with LLM latency. Results land in the per-turn cache.
+    """
+
+    thread_id = config.get('configurable', {}).get('thread_id')
+    retrieval_cache.start_turn(thread_id, turn_key(state['messages']))
+
+    raw_user_message = next((msg.text for msg in reversed(state['messages']) if isinstance(msg, HumanMessage)), "")
+    if len(normalize_query(raw_user_message).split()) >= PREFETCH_MIN_TOKENS:
+        k = 20 # same as 'fetch_canvas_guides' default
+        embedding = cached_emb_model.embed_query(raw_user_message)
+        retrieved_docs = tenant_registry.vectorstore(tenant_of(config)).similarity_search_by_vector(embedding, k=k)
+        retrieval_cache.put(thread_id, raw_user_message, k, retrieved_docs, embedding)
+
+    return {}
+
 ###########################################
 # Creating Workflow
 ###########################################
 # checkpointer = InMemorySaver()
 
-# Setting up Sqlite Saver Checkpointer
-## creating sqlite db and connecting it with checkpointer
+# Setting up Checkpointer (pooled sqlite by default, see checkpoint_store.py)
 #### workflow state at each checkpoint will be stored in the database
-conn = sqlite3.connect(database='chatlogs.db', check_same_thread=False)
-checkpointer = SqliteSaver(conn=conn)
+checkpointer = create_checkpointer(
+    backend=CHECKPOINT_BACKEND,
+    database=CHECKPOINT_DB,
+    postgres_uri=POSTGRES_URI,
+    pool_size=CHECKPOINT_POOL_SIZE,
+    batch_writes=CHECKPOINT_BATCH_WRITES,
+)
+
+# displayable history projection (user/ assistant text only) for lazy history loading
+if CHECKPOINT_BACKEND == "postgres":
+    transcript_store = PostgresTranscriptStore(POSTGRES_URI, max_size=CHECKPOINT_POOL_SIZE)
+else:
+    transcript_store = TranscriptStore(CHECKPOINT_DB, pool_size=CHECKPOINT_POOL_SIZE)
 
 
 graph = StateGraph(ChatState)
@@ -378,6 +667,11 @@ graph.add_node(node='tools', action=tool_node)
 
 graph.add_edge(START, 'chat_node')
 
+if SPECULATIVE_PREFETCH:
+    graph.add_node(node='prefetch', action=prefetch_node)
+    graph.add_edge(START, 'prefetch')
+    graph.add_edge('prefetch', END)
+
 # if the LLM asked for a tool, go to ToolNode else END
 graph.add_conditional_edges('chat_node', tools_condition)
 
@@ -385,16 +679,41 @@ graph.add_edge("tools","chat_node")
 
 chatbot = graph.compile(checkpointer=checkpointer) ## for persistence
 
+batch_chatbot = graph.compile() # single-turn batch questions (batch_answering.py), not persisted
+
 ############################################ 
 # HELPER FUNCS
 ############################################ 
 
-# extracting unique threads from database (sqlite or in-memory)
-all_threads = set()
-
-def retrieve_all_threads():
+# extracting unique threads of a tenant from database (threads without a tenant belong to the default one)
+def retrieve_all_threads(tenant_id=DEFAULT_TENANT_ID):
 
+    all_threads = {}
     for checkpoint in checkpointer.list(None):
-        all_threads.add(checkpoint.config['configurable']['thread_id'])
+        if checkpoint.metadata.get('tenant_id', DEFAULT_TENANT_ID) == tenant_id:
+            all_threads.setdefault(checkpoint.config['configurable']['thread_id'], None)
 
     return list(all_threads)
+
+# last `limit` displayable messages of a thread, pass the returned cursor as `before` for older ones
+def load_history(thread_id, limit=20, before=None):
+    if before is None and not transcript_store.has_thread(thread_id):
+        messages = chatbot.get_state(config={'configurable':{'thread_id':thread_id}}).values.get('messages',[])
+        if not messages:
+            return [], None
+        transcript_store.rebuild(thread_id, messages) # one-off projection of a thread created before it existed
+
+    return transcript_store.page(thread_id, limit=limit, before=before)
+
+# runs one chat turn, checkpoints of the turn are committed together once the stream ends
+def stream_turn(input, config, **kwargs):
+    with checkpointer.batch(config) if CHECKPOINT_BATCH_WRITES else nullcontext():
+        yield from chatbot.stream(input, config=config, **kwargs)
+
+# per-role latency/ token/ cost accounting of LLM calls
+def export_model_usage(path='model_usage.json'):
+    return router.export_usage(path)
+
+# per-turn cache hits/ misses and tokens saved by result merging
+def retrieval_stats():
+    return retrieval_cache.stats()
@@ -0,0 +1,197 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_aws import ChatBedrockConverse
+from collections import defaultdict
+import threading
+import json
+import time
+
+
+###########################################
+# Model Tiers & Role Assignment
+###########################################
+# "strong" model writes the final answers, "fast" model serves auxiliary tool calls
+# (query rewriting, document compression) which sit on the critical path of every turn
+# but don't need the flagship model.
+STRONG = "strong"
+FAST = "fast"
+
+DEFAULT_ROLE_TIERS = {
+    "chat": STRONG,
+    "rewrite_query": FAST,
+    "filter_information": FAST,
+}
+
+# temporary credentials are refreshed this long before they expire
+CREDENTIALS_REFRESH_MARGIN_S = 300
+
+
+###########################################
+# Helper: Usage Accounting
+###########################################
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def _token_counts(message):
+    usage = getattr(message, "usage_metadata", None) or {}
+    return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+
+
+###########################################
+# Model Router
+###########################################
+class ModelRouter:
+    """
+    Assigns a Bedrock model to each LLM role and keeps per-role latency/ token/ cost accounting.
+    Models are built once per (model, system prompt, max_tokens, temperature) and reused across calls.
+
+    paramaters:
+    - model_ids: {tier: model_id} e.g. {"strong": MODEL_ID1, "fast": MODEL_ID2}
+    - region_name: bedrock region
+    - refresh_credentials: callable setting temporary AWS credentials, returns their expiration (datetime or epoch
+      seconds, None = no expiry). Run before the first model is built and again once the credentials are
+      about to expire, which also drops the models built with the old credentials
+    - role_tiers: {role: tier}, defaults to DEFAULT_ROLE_TIERS (unknown roles use the strong tier)
+    - adaptive: escalate to the strong tier when structured output from a weaker tier fails to parse
+    - prices: {model_id: [usd_per_1k_input_tokens, usd_per_1k_output_tokens]}
+    """
+
+    def __init__(self, model_ids, region_name, refresh_credentials=None, role_tiers=None, adaptive=False, prices=None):
+        self._model_ids = {tier: model_id for tier, model_id in model_ids.items() if model_id}
+        if STRONG not in self._model_ids:
+            raise ValueError("a model id for the 'strong' tier is required")
+
+        self._region_name = region_name
+        self._refresh_credentials = refresh_credentials
+        self._role_tiers = dict(DEFAULT_ROLE_TIERS if role_tiers is None else role_tiers)
+        self.adaptive = adaptive
+        self._prices = prices or {}
+
+        self._models = {} # (model_id, system, max_tokens, temperature) -> ChatBedrockConverse
+        self._credentials_expire_at = None # epoch seconds, None = no credentials fetched yet
+        self._credentials_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._usage = defaultdict(lambda: {
+            "calls": 0,
+            "escalations": 0,
+            "parse_failures": 0,
+            "latencies": [],
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "cost_usd": 0.0,
+            "models": defaultdict(int),
+        })
+
+    def tier_for(self, role):
+        tier = self._role_tiers.get(role, STRONG)
+        return tier if tier in self._model_ids else STRONG # missing fast model -> fall back to strong
+
+    def model_for(self, role, tier=None):
+        return self._model_ids[tier or self.tier_for(role)]
+
+    def _ensure_credentials(self):
+        if self._refresh_credentials is None:
+            return
+
+        with self._credentials_lock:
+            expire_at = self._credentials_expire_at
+            if expire_at is not None and (expire_at == float("inf") or time.time() < expire_at - CREDENTIALS_REFRESH_MARGIN_S):
+                return
+
+            expiration = self._refresh_credentials()
+            if expiration is None:
+                self._credentials_expire_at = float("inf")
+            else:
+                self._credentials_expire_at = expiration.timestamp() if hasattr(expiration, "timestamp") else float(expiration)
+            with self._lock:
+                self._models.clear() # their clients hold the old credentials
+
+    def chat_model(self, role, system, tier=None, max_tokens=2500, temperature=0.2):
+        self._ensure_credentials()
+        key = (self.model_for(role, tier), system, max_tokens, temperature)
+
+        with self._lock:
+            model = self._models.get(key)
+        if model is None:
+            model = ChatBedrockConverse(
+                model_id=key[0],
+                region_name=self._region_name,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system=system,
+            )
+            with self._lock:
+                model = self._models.setdefault(key, model) # another thread may have built it meanwhile
+        return model
+
+    def record(self, role, model_id, latency, message=None, escalated=False, parse_failed=False):
+        input_tokens, output_tokens = _token_counts(message)
+        price_in, price_out = self._prices.get(model_id, (0.0, 0.0))
+
+        with self._lock:
+            usage = self._usage[role]
+            usage["calls"] += 1
+            usage["escalations"] += int(escalated)
+            usage["parse_failures"] += int(parse_failed)
+            usage["latencies"].append(latency)
+            usage["input_tokens"] += input_tokens
+            usage["output_tokens"] += output_tokens
+            usage["cost_usd"] += (input_tokens * price_in + output_tokens * price_out) / 1000
+            usage["models"][model_id] += 1
+
+    def invoke_structured(self, role, schema, system, prompt, max_tokens=2500, temperature=0.2):
+        """invoke the role's model with structured output, escalating to the strong tier on parse failure (adaptive mode)"""
+
+        tier = self.tier_for(role)
+        escalated = False
+
+        while True:
+            model_id = self.model_for(role, tier)
+            started = time.perf_counter() # includes credential refreshes/ model builds, they sit on the same critical path
+            structured_output_llm = self.chat_model(role, system, tier, max_tokens, temperature).with_structured_output(schema, include_raw=True)
+            result = structured_output_llm.invoke(prompt)
+            parsed = result.get("parsed")
+            parse_failed = parsed is None
+            self.record(role, model_id, time.perf_counter() - started, result.get("raw"), escalated, parse_failed)
+
+            if not parse_failed:
+                return parsed
+
+            if self.adaptive and tier != STRONG:
+                tier = STRONG
+                escalated = True
+                continue
+
+            raise result.get("parsing_error") or ValueError(f"'{role}' returned no parsable {schema.__name__}")
+
+    def usage_report(self):
+        with self._lock:
+            report = {}
+            for role, usage in self._usage.items():
+                latencies = usage["latencies"]
+                report[role] = {
+                    "calls": usage["calls"],
+                    "escalations": usage["escalations"],
+                    "parse_failures": usage["parse_failures"],
+                    "latency_total_s": round(sum(latencies), 3),
+                    "latency_mean_s": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+                    "latency_p95_s": round(_percentile(latencies, 95), 3),
+                    "input_tokens": usage["input_tokens"],
+                    "output_tokens": usage["output_tokens"],
+                    "cost_usd": round(usage["cost_usd"], 6),
+                    "models": dict(usage["models"]),
+                }
+            return report
+
+    def export_usage(self, path):
+        with open(path, "w") as f:
+            json.dump(self.usage_report(), f, indent=2)
+        return path
@@ -0,0 +1,64 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_core.documents import Document
+from functools import lru_cache
+import shutil
+import json
+import os
+
+
+###########################################
+# Parent Document Store
+###########################################
+class ParentDocumentStore:
+    """
+    Full guide pages ("parents") of the small retrieval units indexed by 00-indexing/structured_indexing.py.
+
+    The vector store only holds the units, each unit carries its page's `parent_id` in metadata so a search
+    can return the matched unit or, on demand, expand it to the whole page. One json file per parent.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._load = lru_cache(maxsize=512)(self._read)
+
+    def _path(self, parent_id):
+        return os.path.join(self._directory, f"{parent_id}.json")
+
+    def _read(self, parent_id):
+        try:
+            with open(self._path(parent_id)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return Document(id=parent_id, page_content=data["page_content"], metadata=data["metadata"])
+
+    def put(self, parent_id, document):
+        os.makedirs(self._directory, exist_ok=True)
+        with open(self._path(parent_id), "w") as f:
+            json.dump({"page_content": document.page_content, "metadata": document.metadata}, f)
+        self._load.cache_clear()
+
+    def get(self, parent_id):
+        return self._load(str(parent_id))
+
+    def expand(self, units):
+        """replace units with their parent pages (each page once, in rank order), units without a stored parent are kept"""
+
+        expanded, seen = [], set()
+        for unit in units:
+            parent_id = unit.metadata.get("parent_id")
+            parent = self.get(parent_id) if parent_id is not None else None
+            if parent is None:
+                expanded.append(unit)
+            elif parent_id not in seen:
+                seen.add(parent_id)
+                expanded.append(parent)
+
+        return expanded
+
+    def clear(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+        self._load.cache_clear()
@@ -0,0 +1,120 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_core.documents import Document
+import hashlib
+import re
+
+
+###########################################
+# Helper: Chunk Identity & Size
+###########################################
+# every indexed chunk is prepended with its guide type and title (see 00-indexing)
+CHUNK_HEADER = re.compile(r"^Guide Type: [^\n]*\n\nDocument Title: [^\n]*\n\n")
+
+MIN_OVERLAP_CHARS = 30
+
+
+def chunk_key(doc):
+    """vector store id of the chunk, content hash when the id is missing"""
+    if getattr(doc, "id", None):
+        return str(doc.id)
+    return hashlib.sha1(doc.page_content.strip().encode("utf-8")).hexdigest()
+
+
+def approx_tokens(text):
+    return len(text) // 4 # ~4 characters per token
+
+
+def _split_header(text):
+    match = CHUNK_HEADER.match(text)
+    if not match:
+        return "", text
+    return match.group(0), text[match.end():]
+
+
+def _overlap(left, right):
+    """length of the longest suffix of left that is a prefix of right (splitter chunk_overlap)"""
+    for size in range(min(len(left), len(right)), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+###########################################
+# Result Merging
+###########################################
+def merge_documents(retrieved_docs, exclude_keys=(), max_per_source=3, source_counts=None):
+    """
+    Merge the retrieved chunks of a turn into one document per source.
+
+    - drops chunks seen earlier in the turn (exclude_keys) or retrieved more than once
+    - keeps at most max_per_source best-ranked chunks per source, chunks of a source handed out
+      earlier in the turn (source_counts: {source: count}) count against the cap
+    - stitches neighbouring chunks of the same source on their shared overlap, other chunks of the
+      same source are joined under a single header
+
+    returns (merged_docs, stats, kept_chunks) where stats reports dropped chunks and approximate tokens
+    saved and kept_chunks are the chunks that made it into merged_docs.
+    """
+
+    exclude_keys = set(exclude_keys)
+    source_counts = source_counts or {}
+    seen = set()
+    by_source = {} # source -> [chunks], insertion order == best rank of the source
+    duplicates = capped = 0
+
+    for doc in retrieved_docs:
+        key = chunk_key(doc)
+        if key in seen or key in exclude_keys:
+            duplicates += 1
+            continue
+        seen.add(key)
+
+        source = doc.metadata.get("source")
+        chunks = by_source.setdefault(source, [])
+        if source_counts.get(source, 0) + len(chunks) >= max_per_source:
+            capped += 1
+            continue
+        chunks.append(doc)
+
+    by_source = {source: chunks for source, chunks in by_source.items() if chunks}
+
+    merged_docs = []
+    for source, chunks in by_source.items():
+        header, text = _split_header(chunks[0].page_content.strip())
+
+        for chunk in chunks[1:]:
+            body = _split_header(chunk.page_content.strip())[1]
+            if body in text:
+                continue
+            if overlap := _overlap(text, body):
+                text = text + body[overlap:]
+            elif overlap := _overlap(body, text):
+                text = body + text[overlap:]
+            else:
+                text = text + "\n\n...\n\n" + body
+
+        merged_docs.append(Document(
+            page_content=header + text,
+            metadata={**chunks[0].metadata, "merged_chunks": len(chunks)},
+        ))
+
+    tokens_before = sum(approx_tokens(doc.page_content) for doc in retrieved_docs)
+    tokens_after = sum(approx_tokens(doc.page_content) for doc in merged_docs)
+
+    stats = {
+        "chunks_in": len(retrieved_docs),
+        "chunks_kept": sum(len(chunks) for chunks in by_source.values()),
+        "docs_out": len(merged_docs),
+        "duplicates_dropped": duplicates,
+        "capped_dropped": capped,
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+    }
+
+    kept_chunks = [chunk for chunks in by_source.values() for chunk in chunks]
+
+    return merged_docs, stats, kept_chunks
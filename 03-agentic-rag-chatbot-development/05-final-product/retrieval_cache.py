@@ -0,0 +1,176 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from collections import OrderedDict
+import threading
+import math
+import re
+
+
+###########################################
+# Helper: Query Normalization
+###########################################
+def normalize_query(query):
+    return " ".join(re.findall(r"[a-z0-9]+", query.lower()))
+
+
+def cosine_similarity(vector_a, vector_b):
+    norm = math.sqrt(sum(a * a for a in vector_a)) * math.sqrt(sum(b * b for b in vector_b))
+    return sum(a * b for a, b in zip(vector_a, vector_b)) / norm if norm else 0.0
+
+
+###########################################
+# Per-Turn Retrieval Cache
+###########################################
+class TurnRetrievalCache:
+    """
+    Retrieved documents of the current turn, keyed by thread_id.
+
+    The speculative prefetch stage fills it with results for the raw user message while the agent is
+    still thinking, 'fetch_canvas_guides' consults it before hitting the vector store. A lookup hits on
+    an exact normalized match retrieved with at least k documents, or on a prefetched entry whose query
+    is a near-duplicate (cosine similarity of the query embeddings >= similarity_threshold). Token
+    overlap is no measure here: a rewritten query drops the wording of the raw message but keeps its
+    meaning, while a negation changes the meaning with a single token. Only the prefetch stores its
+    embedding: sub-queries of the same turn ("edit a discussion post"/ "delete a discussion post") are
+    near-duplicates by embedding too but need their own results.
+
+    It also remembers which chunks were already handed to the agent during the turn so that later
+    retrievals don't repeat them, and totals the tokens saved by result merging.
+
+    Threads can join a group (batch runs group near-identical questions) to share retrieval results with
+    the group's other threads beyond their own turn. Compressions keep only what is relevant to one
+    question, they are shared only between threads asking the same (normalized) question.
+    """
+
+    def __init__(self, similarity_threshold=0.85, max_threads=256):
+        self._similarity_threshold = similarity_threshold
+        self._max_threads = max_threads
+        self._turns = OrderedDict() # thread_id -> {"turn_key", "entries": {normalized_query: (k, docs, embedding)}, "seen": set(), "source_counts": {source: count}, "lock"}
+        self._groups = {} # group_id -> {"members": set(), "entries": {normalized_query: (k, docs, embedding)}, "compressed": {(normalized question, docs): compressed_docs}}
+        self._thread_groups = {} # thread_id -> group_id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compression_hits = 0
+        self.merge_totals = {"merges": 0, "duplicates_dropped": 0, "capped_dropped": 0, "tokens_saved": 0}
+
+    def _turn(self, thread_id):
+        turn = self._turns.get(thread_id)
+        if turn is None:
+            turn = self._turns[thread_id] = {"turn_key": None, "entries": {}, "seen": set(), "source_counts": {}, "lock": threading.Lock()}
+        self._turns.move_to_end(thread_id)
+        while len(self._turns) > self._max_threads:
+            self._turns.popitem(last=False)
+        return turn
+
+    def start_turn(self, thread_id, turn_key=None):
+        """reset the thread's cache, a no-op when the turn identified by turn_key has already started"""
+        with self._lock:
+            turn = self._turn(thread_id)
+            if turn_key is not None and turn["turn_key"] == turn_key:
+                return
+            turn.update(turn_key=turn_key, entries={}, seen=set(), source_counts={})
+
+    def join_group(self, thread_id, group_id):
+        with self._lock:
+            self._thread_groups[thread_id] = group_id
+            self._groups.setdefault(group_id, {"members": set(), "entries": {}, "compressed": {}})["members"].add(thread_id)
+
+    def leave_group(self, thread_id):
+        """the group's shared results are dropped once its last thread has left"""
+        with self._lock:
+            group_id = self._thread_groups.pop(thread_id, None)
+            group = self._groups.get(group_id)
+            if group is not None:
+                group["members"].discard(thread_id)
+                if not group["members"]:
+                    del self._groups[group_id]
+
+    def _group(self, thread_id):
+        return self._groups.get(self._thread_groups.get(thread_id))
+
+    def put(self, thread_id, query, k, docs, embedding=None):
+        """with an embedding (speculative prefetch only) the entry also serves near-duplicate queries"""
+        entry = (k, list(docs), embedding)
+        with self._lock:
+            self._turn(thread_id)["entries"][normalize_query(query)] = entry
+            group = self._group(thread_id)
+            if group is not None:
+                group["entries"][normalize_query(query)] = entry
+
+    def get(self, thread_id, query, k, embedding=None):
+        """without an embedding only an exact (normalized) match hits"""
+        normalized = normalize_query(query)
+
+        with self._lock:
+            entries = self._turns[thread_id]["entries"] if thread_id in self._turns else {}
+            group = self._group(thread_id)
+            if group is not None:
+                entries = {**group["entries"], **entries}
+
+            best_docs, best_score = None, 0.0
+            for cached_query, (cached_k, docs, cached_embedding) in entries.items():
+                if cached_k < k:
+                    continue
+                if cached_query == normalized:
+                    score = 1.0
+                elif embedding is not None and cached_embedding is not None:
+                    score = cosine_similarity(cached_embedding, embedding)
+                else:
+                    continue
+                if score >= self._similarity_threshold and score > best_score:
+                    best_docs, best_score = docs, score
+
+            if best_docs is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return best_docs[:k]
+
+    def get_compressed(self, thread_id, question, docs):
+        """compressed version of exactly these docs made for the same question by another thread of the group, None otherwise"""
+        with self._lock:
+            group = self._group(thread_id)
+            compressed_docs = group["compressed"].get((normalize_query(question), tuple(docs))) if group is not None else None
+            if compressed_docs is not None:
+                self.compression_hits += 1
+            return compressed_docs
+
+    def put_compressed(self, thread_id, question, docs, compressed_docs):
+        with self._lock:
+            group = self._group(thread_id)
+            if group is not None:
+                group["compressed"][(normalize_query(question), tuple(docs))] = list(compressed_docs)
+
+    def turn_lock(self, thread_id):
+        """serializes merges of the thread's concurrent retrievals (parallel tool calls) within the turn"""
+        with self._lock:
+            return self._turn(thread_id)["lock"]
+
+    def handed_over(self, thread_id):
+        """(chunk keys, {source: chunk count}) handed to the agent so far this turn"""
+        with self._lock:
+            turn = self._turn(thread_id)
+            return set(turn["seen"]), dict(turn["source_counts"])
+
+    def mark_seen(self, thread_id, chunks):
+        """record chunks [(chunk key, source)] handed to the agent this turn"""
+        with self._lock:
+            turn = self._turn(thread_id)
+            for key, source in chunks:
+                if key not in turn["seen"]:
+                    turn["seen"].add(key)
+                    turn["source_counts"][source] = turn["source_counts"].get(source, 0) + 1
+
+    def record_merge(self, stats):
+        with self._lock:
+            self.merge_totals["merges"] += 1
+            for key in ("duplicates_dropped", "capped_dropped", "tokens_saved"):
+                self.merge_totals[key] += stats[key]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "compression_hits": self.compression_hits, **self.merge_totals}
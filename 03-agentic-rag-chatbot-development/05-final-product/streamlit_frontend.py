@@ -1,8 +1,10 @@
 import streamlit as st
 from langchain_core.messages import  HumanMessage, AIMessage, AIMessageChunk
-from langgraph_backend import chatbot, retrieve_all_threads
+from langgraph_backend import retrieve_all_threads, stream_turn, load_history, tenant_registry, DEFAULT_TENANT_ID
 import uuid
 
+HISTORY_PAGE_SIZE = 20 # messages loaded when opening a chat, older ones are loaded on demand
+
 ############################################ 
 # Utilities
 ############################################ 
@@ -14,6 +16,7 @@ def reset_chat():
     thread_id = generate_thread_id()
     st.session_state['current_session'] = thread_id
     st.session_state['conversation_history'] = []
+    st.session_state['history_cursor'] = None
     return thread_id
 
 def add_chat_to_session(chat_number, thread_id):
@@ -23,24 +26,15 @@ def add_chat_to_session(chat_number, thread_id):
 
 def load_chat(thread_id):
     
-    state = chatbot.get_state(config={'configurable':{'thread_id':thread_id}}).values
-    messages = state.get('messages',[])
-    filtered_messages = list(filter(lambda msg: isinstance(msg,(HumanMessage,AIMessage)) and msg.text.strip(), messages))
-
-    return filtered_messages
-
-def message_converter(message):
-    if isinstance(message, HumanMessage):
-        return {
-            'role': 'user',
-            'content': message.text
-        }
-    
-    if isinstance(message, AIMessage):
-        return {
-            'role': 'assistant',
-            'content': message.text,
-        }
+    messages, cursor = load_history(thread_id, limit=HISTORY_PAGE_SIZE)
+    st.session_state['conversation_history'] = messages
+    st.session_state['history_cursor'] = cursor
+
+def load_older_messages():
+
+    messages, cursor = load_history(st.session_state['current_session'], limit=HISTORY_PAGE_SIZE, before=st.session_state['history_cursor'])
+    st.session_state['conversation_history'] = messages + st.session_state['conversation_history']
+    st.session_state['history_cursor'] = cursor
 
 
 def edit_last_message():
@@ -53,13 +47,18 @@ def edit_last_message():
 # Session Setup
 ############################################ 
 
+# institution (tenant) of this deployment, overridable per link with ?tenant=<tenant_id>
+if 'tenant_id' not in st.session_state:
+    st.session_state['tenant_id'] = st.query_params.get('tenant') or DEFAULT_TENANT_ID
+    tenant_registry.tenant(st.session_state['tenant_id']) # fail early on an unknown tenant
+
 # initilize conversation_history if not present
 if 'conversation_history' not in st.session_state:
     st.session_state['conversation_history'] = []
 
 # initilize chat_threads if not present
 if 'chat_threads' not in st.session_state:
-    st.session_state['chat_threads'] = {f'chat-{chat_number}':thread_id for chat_number, thread_id in enumerate(retrieve_all_threads(), start=1)}
+    st.session_state['chat_threads'] = {f'chat-{chat_number}':thread_id for chat_number, thread_id in enumerate(retrieve_all_threads(st.session_state['tenant_id']), start=1)}
     st.session_state['total_chats'] = len(st.session_state['chat_threads']) + 1
 
 
@@ -72,10 +71,11 @@ if "last_message" not in st.session_state:
     st.session_state['last_message'] = ""
 
 st.session_state.setdefault("edit_mode", False)
+st.session_state.setdefault("history_cursor", None)
 
-# new CONFIG allows us to group traces by thread_id's
-CONFIG = {'configurable':{'thread_id':st.session_state['current_session']},
-          'metadata':{'thread_id':st.session_state['current_session']},
+# new CONFIG allows us to group traces by thread_id's (and tenant_id's), tenant_id also routes the turn to the tenant's knowledge base
+CONFIG = {'configurable':{'thread_id':st.session_state['current_session'], 'tenant_id':st.session_state['tenant_id']},
+          'metadata':{'thread_id':st.session_state['current_session'], 'tenant_id':st.session_state['tenant_id']},
           'run_name': 'chat_turn'} # each interaction is logged by LangSmith if needed, each trace will be named "chat_turn"
 
 
@@ -143,8 +143,7 @@ st.sidebar.header('Chats')
 for chat in list(st.session_state['chat_threads'].keys())[::-1]:
     if st.sidebar.button(label = f"💬 {chat.replace('-',' ')}", width='stretch'):
         st.session_state['current_session'] = st.session_state['chat_threads'][chat]
-        messages = list(map(message_converter,load_chat(st.session_state['chat_threads'][chat])))
-        st.session_state['conversation_history'] = messages
+        load_chat(st.session_state['chat_threads'][chat])
 
 
 
@@ -152,6 +151,10 @@ for chat in list(st.session_state['chat_threads'].keys())[::-1]:
 # Main UI
 ############################################ 
 
+# older messages of long chats are only loaded on demand
+if st.session_state['history_cursor'] is not None:
+    st.button('Load older messages', icon='🕘', type='tertiary', on_click=load_older_messages)
+
 # load chat history in UI
 for message in st.session_state['conversation_history']:
     with st.chat_message(message['role']):
@@ -206,15 +209,17 @@ if user_input:
 
             last_msg_id = None
             
-            stream = chatbot.stream({"messages":{"op":"edit_last_msg", "text":user_input}}, config=CONFIG,stream_mode=["messages","custom"]) if st.session_state['edit_mode'] else chatbot.stream({"messages":[HumanMessage(content=user_input)]}, config=CONFIG,stream_mode=["messages","custom"])
+            # subgraphs=True: tool-call trace of the retrieval pipeline subgraph ('search_canvas_knowledge') is only relayed to subgraph-aware streams
+            stream = stream_turn({"messages":{"op":"edit_last_msg", "text":user_input}}, config=CONFIG,stream_mode=["messages","custom"],subgraphs=True) if st.session_state['edit_mode'] else stream_turn({"messages":[HumanMessage(content=user_input)]}, config=CONFIG,stream_mode=["messages","custom"],subgraphs=True)
 
             st.session_state['edit_mode'] = False
 
-            for stream_mode, message_chunk in stream:
+            for namespace, stream_mode, message_chunk in stream:
 
                 # print(message_chunk)
                 if stream_mode == "messages":
-                    if not isinstance(message_chunk[0], (AIMessage, AIMessageChunk)):
+                    # only the agent's own replies, not LLM calls made inside the retrieval subgraph
+                    if namespace or not isinstance(message_chunk[0], (AIMessage, AIMessageChunk)):
                         continue
                     
                     if getattr(message_chunk[0], "chunk_position", None) == "last":
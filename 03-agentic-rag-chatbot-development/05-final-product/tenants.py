@@ -0,0 +1,153 @@
+###########################################
+# IMPORTING REQUIREMENTS
+###########################################
+
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
+from langchain_chroma import Chroma
+from chromadb.config import Settings
+from parent_store import ParentDocumentStore
+from collections import OrderedDict
+import threading
+import json
+import os
+
+
+###########################################
+# Tenant Configuration
+###########################################
+# each institution (tenant) gets its own knowledge base collection (Canvas guides + its own additions)
+# and its own support details in the system prompt. Requests without a tenant_id go to the deployment's
+# default tenant (TENANT_ID), which must be one of the configured tenants
+DEFAULT_TENANT_ID = os.getenv("TENANT_ID", "rmit")
+
+DEFAULT_TENANTS = {
+    "rmit": {
+        "institution": "RMIT",
+        "collection_name": "guides",
+        "parent_docstore": "../data/parent_docstore",
+        "support": {
+            "name": "RMIT IT SUPPORT",
+            "phone": "+61399258000",
+            "email": "support@rmit.com",
+            "website": "https://www.rmit.edu.au/students/support-services/it-support-systems/it-service-connect",
+        },
+    },
+}
+
+
+def load_tenants(path=None, default_tenant_id=DEFAULT_TENANT_ID):
+    """tenant configs from a json file ({tenant_id: config}, same shape as DEFAULT_TENANTS), defaults when no file is given"""
+    if path:
+        with open(path) as f:
+            tenants = json.load(f)
+    else:
+        tenants = json.loads(json.dumps(DEFAULT_TENANTS))
+
+    for tenant_id, tenant in tenants.items():
+        missing = {"institution", "collection_name", "support"} - tenant.keys()
+        if missing:
+            raise ValueError(f"tenant '{tenant_id}' is missing {sorted(missing)}")
+
+    if default_tenant_id not in tenants:
+        raise ValueError(f"default tenant '{default_tenant_id}' is not configured, known: {sorted(tenants)}")
+    return tenants
+
+
+def tenant_of(config):
+    return (config or {}).get('configurable', {}).get('tenant_id') or DEFAULT_TENANT_ID
+
+
+def parent_docstore_path(tenant_id, tenant):
+    """
+    parent page store of a tenant, a sibling of the default tenant's store when not configured (never
+    nested inside it, re-indexing clears the whole directory)
+    """
+    return tenant.get("parent_docstore") or f"../data/parent_docstore_{tenant_id}"
+
+
+###########################################
+# Shared Embedding Cache
+###########################################
+def shared_embeddings(embedding_model, cache_dir, namespace):
+    """
+    document embeddings cached by content hash on disk. The indexer embeds every tenant's collection
+    through it, so identical chunks (e.g. the common Canvas guides) are only embedded once. Queries are
+    not cached on disk (one file per user query, unbounded), a turn embeds its queries once and reuses
+    them through the turn retrieval cache.
+    """
+    return CacheBackedEmbeddings.from_bytes_store(
+        embedding_model,
+        LocalFileStore(cache_dir),
+        namespace=namespace,
+        query_embedding_cache=False,
+        key_encoder="sha256",
+    )
+
+
+###########################################
+# Tenant Registry
+###########################################
+class TenantRegistry:
+    """
+    Per-tenant knowledge base handles, opened lazily on first use and LRU evicted beyond max_open_stores,
+    all sharing one (cached) embedding function.
+
+    Evicting a handle only drops the langchain wrapper: every collection under persist_directory lives in
+    one shared chromadb client, which keeps the loaded (hnsw) segments in memory. That memory is bounded by
+    chromadb's LRU segment cache instead (memory_limit_bytes, None = unbounded).
+    """
+
+    def __init__(self, tenants, embedding_function, persist_directory, max_open_stores=8, memory_limit_bytes=None):
+        self._tenants = tenants
+        self._embedding_function = embedding_function
+        self._persist_directory = persist_directory
+        self._max_open_stores = max_open_stores
+        self._client_settings = None
+        if memory_limit_bytes:
+            self._client_settings = Settings(
+                is_persistent=True,
+                persist_directory=persist_directory,
+                chroma_segment_cache_policy="LRU",
+                chroma_memory_limit_bytes=memory_limit_bytes,
+            )
+        self._stores = OrderedDict() # tenant_id -> (vectorstore, parent_store)
+        self._lock = threading.Lock()
+
+    def tenant(self, tenant_id):
+        if tenant_id not in self._tenants:
+            raise ValueError(f"unknown tenant '{tenant_id}'")
+        return self._tenants[tenant_id]
+
+    def tenant_ids(self):
+        return list(self._tenants)
+
+    def _open(self, tenant_id):
+        with self._lock:
+            if tenant_id in self._stores:
+                self._stores.move_to_end(tenant_id)
+                return self._stores[tenant_id]
+
+        tenant = self.tenant(tenant_id)
+        stores = (
+            Chroma(
+                embedding_function=self._embedding_function,
+                collection_name=tenant["collection_name"],
+                persist_directory=self._persist_directory,
+                client_settings=self._client_settings,
+            ),
+            ParentDocumentStore(parent_docstore_path(tenant_id, tenant)),
+        )
+
+        with self._lock:
+            stores = self._stores.setdefault(tenant_id, stores) # another thread may have opened it meanwhile
+            self._stores.move_to_end(tenant_id)
+            while len(self._stores) > self._max_open_stores:
+                self._stores.popitem(last=False)
+            return stores
+
+    def vectorstore(self, tenant_id):
+        return self._open(tenant_id)[0]
+
+    def parent_store(self, tenant_id):
+        return self._open(tenant_id)[1]